@@ -0,0 +1 @@
+# Бенчмарки и нагрузочные сценарии. Запускаются из корня репозитория: python -m bench.<модуль>
@@ -0,0 +1,203 @@
+# Локальные заглушки Telegram Bot API и OpenWeatherMap с настраиваемой задержкой и долей ошибок.
+#
+#   tg = FakeTelegram(latency=0.05, error_rate=0.01).start()
+#   telebot.apihelper.API_URL = tg.api_url
+#   owm = FakeOpenWeatherMap(latency=0.2).start()
+#   os.environ["OWM_BASE_URL"] = owm.base_url   # до импорта weather / geo
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CONDITIONS = ["Clear", "Clouds", "Rain", "Snow", "Drizzle", "Thunderstorm"]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class FakeUpstream:
+    """Базовая заглушка: задержка latency ± jitter, ошибка error_status с вероятностью error_rate."""
+
+    error_status = 500
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.requests = 0
+        self.errors = 0
+        self.paths = {}
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self._server.server_address[1]}"
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                status, payload = upstream._dispatch(self.command, self.path, body)
+                data = json.dumps(payload).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # клиент не дождался ответа (таймаут) — обычное дело в сценарии outage
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _Server((self.host, self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _dispatch(self, method, path, body):
+        with self._lock:
+            self.requests += 1
+            route = urlparse(path).path
+            self.paths[route] = self.paths.get(route, 0) + 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if fail:
+            return self.error_response()
+        return self.handle(method, path, body)
+
+    def error_response(self):
+        return self.error_status, {"cod": self.error_status, "message": "fake upstream error"}
+
+    def handle(self, method, path, body):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "paths": dict(self.paths)}
+
+
+class FakeTelegram(FakeUpstream):
+    """Bot API: sendMessage, sendPhoto и прочие методы отвечают ok. Ошибки — 429 с retry_after."""
+
+    error_status = 429
+
+    def __init__(self, retry_after=1, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_after = retry_after
+        self._message_id = 0
+
+    @property
+    def api_url(self):
+        """Шаблон для telebot.apihelper.API_URL."""
+        return self.base_url + "/bot{0}/{1}"
+
+    def error_response(self):
+        return 429, {"ok": False, "error_code": 429,
+                     "description": f"Too Many Requests: retry after {self.retry_after}",
+                     "parameters": {"retry_after": self.retry_after}}
+
+    def handle(self, method, path, body):
+        api_method = urlparse(path).path.rsplit("/", 1)[-1]
+        chat_id = 0
+        if body[:1] == b"{":
+            chat_id = json.loads(body).get("chat_id", 0)
+        else:
+            params = parse_qs(urlparse(path).query)
+            chat_id = int(params.get("chat_id", ["0"])[0] or 0)
+        if api_method in ("getMe",):
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}}
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        return 200, {"ok": True, "result": {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": "ok",
+        }}
+
+
+class FakeOpenWeatherMap(FakeUpstream):
+    """/data/2.5/weather, /data/2.5/forecast и /geo/1.0/direct. Ответы детерминированы по координатам и названию города."""
+
+    def __init__(self, unknown_cities=("zzz", "nowhere"), **kwargs):
+        super().__init__(**kwargs)
+        self.unknown_cities = set(unknown_cities)
+
+    @staticmethod
+    def _digest(text):
+        return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+
+    def handle(self, method, path, body):
+        url = urlparse(path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/data/2.5/weather":
+            return 200, self.weather(float(params["lat"]), float(params["lon"]))
+        if url.path == "/data/2.5/forecast":
+            return 200, self.forecast(float(params["lat"]), float(params["lon"]))
+        if url.path == "/geo/1.0/direct":
+            return 200, self.geocode(params.get("q", ""))
+        return 404, {"cod": 404, "message": "not found"}
+
+    def weather(self, lat, lon):
+        h = self._digest(f"{lat:.2f},{lon:.2f}")
+        condition = CONDITIONS[h % len(CONDITIONS)]
+        temp = round(-10 + (h >> 4) % 45 + (h % 10) / 10, 1)
+        return {
+            "coord": {"lon": lon, "lat": lat},
+            "weather": [{"id": 800, "main": condition, "description": condition.lower(), "icon": "01d"}],
+            "main": {"temp": temp, "temp_min": temp - 2, "temp_max": temp + 3, "humidity": 50},
+            "dt": int(time.time()) // 600 * 600,
+            "name": "Bench",
+            "cod": 200,
+        }
+
+    def forecast(self, lat, lon, slots=40):
+        """5 дней по 3 часа от ближайшего кратного трём часам момента."""
+        start = int(time.time()) // 10800 * 10800 + 10800
+        items = []
+        for i in range(slots):
+            h = self._digest(f"{lat:.2f},{lon:.2f},{i}")
+            condition = CONDITIONS[h % len(CONDITIONS)]
+            temp = round(-10 + (h >> 4) % 45 + (h % 10) / 10, 1)
+            items.append({
+                "dt": start + i * 10800,
+                "main": {"temp": temp, "temp_min": temp - 1, "temp_max": temp + 1, "humidity": 50},
+                "weather": [{"id": 800, "main": condition, "description": condition.lower(), "icon": "01d"}],
+                "pop": round((h >> 8) % 101 / 100, 2),
+            })
+        return {"cod": "200", "cnt": slots, "list": items,
+                "city": {"name": "Bench", "coord": {"lat": lat, "lon": lon}, "timezone": 0}}
+
+    def geocode(self, query):
+        name = query.strip()
+        if not name or name.casefold() in self.unknown_cities:
+            return []
+        h = self._digest(name.casefold())
+        return [{"name": name.title(), "lat": 41 + h % 1900 / 100, "lon": 20 + (h >> 12) % 4000 / 100,
+                 "country": "RU"}]
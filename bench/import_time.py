@@ -0,0 +1,71 @@
+# Время холодного импорта модулей бота по python -X importtime и проверка, что тяжёлые зависимости
+# (matplotlib, gspread, numpy, ...) не загружаются там, где они не нужны.
+# Запуск: python -m bench.import_time                 (все модули из MODULES)
+#         python -m bench.import_time worker db --top 15
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["db", "notifier", "worker", "bot", "bot_async", "webhook", "sheets", "charts"]
+HEAVY = ["matplotlib", "gspread", "oauth2client", "numpy", "pandas", "timezonefinder"]
+# Модули, которым тяжёлые зависимости при импорте запрещены: процессы рассылки и основной бот
+LEAN = {"db", "notifier", "worker", "bot", "bot_async", "webhook"}
+
+
+def profile(module, repeat=3):
+    """
+    Импортирует module в чистом интерпретаторе repeat раз. Возвращает (лучшее суммарное время в мс,
+    строки отчёта importtime лучшего прогона: (self_us, cumulative_us, имя)).
+    """
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_TOKEN", "123456:BENCH")
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                              capture_output=True, text=True, env=env, cwd=ROOT)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {module} завершился с ошибкой:\n{proc.stderr[-2000:]}")
+        rows = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+        total = next((cum for _, cum, name in reversed(rows) if name.strip() == module), sum(r[0] for r in rows))
+        if best is None or total < best[0]:
+            best = (total, rows)
+    return best[0] / 1000, best[1]
+
+
+def heavy_loaded(rows):
+    """Какие из HEAVY попали в импорт."""
+    loaded = {name.strip().split(".")[0] for _, _, name in rows}
+    return [name for name in HEAVY if name in loaded]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Профиль времени импорта (python -X importtime)")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--top", type=int, default=5, help="сколько самых тяжёлых пакетов показать")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    violations = []
+    for module in args.modules:
+        total_ms, rows = profile(module, args.repeat)
+        heavy = heavy_loaded(rows)
+        # Самые тяжёлые пакеты (не подмодули) внутри импорта, по суммарному времени
+        top = sorted((r for r in rows if r[2].startswith("  ") and "." not in r[2]), key=lambda r: -r[1])[:args.top]
+        print(f"{module}: {total_ms:.1f} мс, тяжёлые зависимости: {', '.join(heavy) or 'нет'}")
+        for _, cumulative_us, name in top:
+            print(f"    {cumulative_us / 1000:8.1f} мс  {name.strip()}")
+        if module in LEAN and heavy:
+            violations.append(f"{module}: {', '.join(heavy)}")
+
+    if violations:
+        print("Тяжёлые зависимости загружаются при импорте:\n  " + "\n  ".join(violations))
+        sys.exit(1)
@@ -0,0 +1,328 @@
+# Нагрузочные сценарии bot.py против локальных заглушек Telegram и OpenWeatherMap.
+# Запуск: python -m bench.run --users 5000 --owm-latency 0.2 --tg-latency 0.05
+#         python -m bench.run --scenarios analytics --compare bench/results/<прошлый прогон>.json
+# Результаты (p50/p95/p99, пропускная способность, запросы к заглушкам) сохраняются в bench/results/.
+import argparse
+import datetime
+import functools
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fake_servers import FakeOpenWeatherMap, FakeTelegram
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+SCENARIOS = ("morning", "analytics", "city_storm", "outage")
+
+
+def percentile(values, p):
+    """Перцентиль p (0..100) методом ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, wall_time, errors=0):
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "wall_time": round(wall_time, 3),
+        "throughput": round(len(latencies) / wall_time, 1) if wall_time else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def _timed_calls(func, args_list, concurrency):
+    """Выполняет func(*args) для каждого набора аргументов в пуле потоков, возвращает (задержки, ошибки, время)."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def call(args):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            func(*args)
+            ok = True
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, args_list))
+    return latencies, errors, time.perf_counter() - started
+
+
+def _user_json(tg_id):
+    return {"id": tg_id, "is_bot": False, "first_name": f"user{tg_id}"}
+
+
+def _message_json(tg_id, text):
+    return {"message_id": 1, "date": int(time.time()), "chat": {"id": tg_id, "type": "private"},
+            "from": _user_json(tg_id), "text": text}
+
+
+def _wait_delivered(bot_module, timeout=60):
+    """Ответы обработчиков уходят через очередь outbox: ждём, пока дорисуются диаграммы и очередь опустеет."""
+    import charts
+
+    deadline = time.monotonic() + timeout
+    while charts.renderer.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    bot_module.outbox.drain(max(0.0, deadline - time.monotonic()))
+
+
+# -------------------- Сценарии --------------------
+def scenario_morning(bot_module, tg_ids, args):
+    """Утренняя волна: у всех пользователей наступило уведомление, один проход рассылки."""
+    import db
+    import notifier
+    from bench import synthetic_users
+
+    synthetic_users.generate_users(len(tg_ids), due_now=True)
+
+    send_latencies = []
+    lock = threading.Lock()
+    original_send = bot_module.bot.send_message
+
+    def timed_send(*a, **kw):
+        started = time.perf_counter()
+        try:
+            return original_send(*a, **kw)
+        finally:
+            with lock:
+                send_latencies.append(time.perf_counter() - started)
+
+    bot_module.bot.send_message = timed_send
+    try:
+        stats = notifier.run_morning_notifications(bot_module.bot, global_rate=args.tg_rate)
+    finally:
+        bot_module.bot.send_message = original_send
+    db.flush_writes()
+
+    result = summarize(send_latencies, stats["wall_time"], stats["failed"])
+    # Для рассылки пропускная способность — доставленные уведомления в секунду всего прохода
+    result["throughput"] = stats["throughput"]
+    result["users"] = stats["users"]
+    result["locations"] = stats["locations"]
+    return result
+
+
+def scenario_analytics(bot_module, tg_ids, args):
+    """Клики по кнопкам аналитики: разные пользователи и периоды, concurrency параллельно."""
+    from telebot import types
+    import charts
+
+    periods = ["analytics_week", "analytics_month", "analytics_quarter"]
+    calls = []
+    for i in range(args.clicks):
+        tg_id = tg_ids[i % min(len(tg_ids), args.click_users)]
+        calls.append((types.CallbackQuery.de_json({
+            "id": str(i), "from": _user_json(tg_id), "chat_instance": "bench",
+            "data": periods[i % len(periods)], "message": _message_json(tg_id, "menu"),
+        }),))
+    started = time.perf_counter()
+    latencies, errors, wall = _timed_calls(bot_module.handle_analytics_callback, calls, args.concurrency)
+    _wait_delivered(bot_module)
+    result = summarize(latencies, wall, errors)
+    result["delivered_wall_time"] = round(time.perf_counter() - started, 3)
+    result["charts"] = charts.renderer.stats()
+    return result
+
+
+def scenario_city_storm(bot_module, tg_ids, args):
+    """Шторм смены города: много пользователей одновременно пишут названия (часть повторяется, часть неизвестна)."""
+    from telebot import types
+    from bench import synthetic_users
+
+    names = [c[0] for c in synthetic_users.CITIES] + [f"Town {i}" for i in range(args.distinct_cities)] + ["zzz"]
+    messages = [(types.Message.de_json(_message_json(tg_ids[i % len(tg_ids)], names[i % len(names)])),)
+                for i in range(args.city_messages)]
+    started = time.perf_counter()
+    latencies, errors, wall = _timed_calls(bot_module.save_city, messages, args.concurrency)
+    _wait_delivered(bot_module)
+    result = summarize(latencies, wall, errors)
+    result["delivered_wall_time"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def scenario_outage(bot_module, tg_ids, args, owm):
+    """
+    Отказ OpenWeatherMap: кэш прогрет, ответы истекли, API перестаёт отвечать (таймауты).
+    Рассылка должна пройти по устаревшим ответам без ожидания таймаутов, а предохранитель —
+    замкнуться сам, когда заглушка снова заработает.
+    """
+    import db
+    import notifier
+    import weather
+    from bench import synthetic_users
+    from weather_cache import weather_cache
+
+    synthetic_users.generate_users(len(tg_ids), due_now=True)
+    ttl, timeout = weather_cache.ttl, weather.REQUEST_TIMEOUT
+    breaker = weather.owm_breaker
+    recovery_timeout = breaker.recovery_timeout
+    weather_cache.clear()
+    weather_cache.ttl = 0.5
+    for lat, lon in notifier.group_by_location(db.get_all_users()):
+        weather_cache.get(lat, lon)
+    time.sleep(weather_cache.ttl)
+
+    # Заглушка "зависает": каждый запрос дольше таймаута клиента
+    owm.latency, owm.jitter = args.outage_timeout * 2, 0.0
+    weather.REQUEST_TIMEOUT = args.outage_timeout
+    breaker.recovery_timeout = args.outage_timeout
+    stale_before = weather_cache.stats()["stale"]
+    synthetic_users.generate_users(len(tg_ids), due_now=True)
+    try:
+        stats = notifier.run_morning_notifications(bot_module.bot, global_rate=args.tg_rate)
+        breaker_stats = breaker.stats()
+
+        owm.latency, owm.jitter = args.owm_latency, args.owm_latency / 2
+        started = time.perf_counter()
+        while breaker.state != "closed" and time.perf_counter() - started < args.outage_timeout * 10:
+            time.sleep(0.05)
+        recovery = time.perf_counter() - started
+    finally:
+        weather_cache.ttl, weather.REQUEST_TIMEOUT = ttl, timeout
+        breaker.recovery_timeout = recovery_timeout
+
+    return {
+        "wall_time": stats["wall_time"],
+        "sent": stats["sent"],
+        "failed": stats["failed"],
+        "fetch_errors": stats["fetch_errors"],
+        "stale_served": weather_cache.stats()["stale"] - stale_before,
+        "breaker": breaker_stats,
+        "recovered": breaker.state == "closed",
+        "recovery_s": round(recovery, 3),
+    }
+
+
+# -------------------- Запуск --------------------
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def run(args):
+    tg = FakeTelegram(latency=args.tg_latency, jitter=args.tg_latency / 2, error_rate=args.tg_error_rate,
+                      seed=1).start()
+    owm = FakeOpenWeatherMap(latency=args.owm_latency, jitter=args.owm_latency / 2,
+                             error_rate=args.owm_error_rate, seed=2).start()
+
+    # Модули читают адреса и ключи при импорте, поэтому окружение настраиваем до импорта
+    os.environ["OWM_BASE_URL"] = owm.base_url
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCH")
+    os.environ.setdefault("WEATHER_API_KEY", "bench")
+
+    import telebot
+    telebot.apihelper.API_URL = tg.api_url
+
+    import db
+    from bench import synthetic_users
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "output")},
+        "scenarios": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, "bench.db")
+        db.init_db()
+        tg_ids = synthetic_users.generate_users(args.users)
+        synthetic_users.generate_samples(tg_ids[:args.click_users], days=args.days)
+
+        import bot as bot_module
+
+        runners = {"morning": scenario_morning, "analytics": scenario_analytics, "city_storm": scenario_city_storm,
+                   "outage": functools.partial(scenario_outage, owm=owm)}
+        for name in args.scenarios:
+            tg_before, owm_before = tg.stats()["requests"], owm.stats()["requests"]
+            result = runners[name](bot_module, tg_ids, args)
+            result["telegram_requests"] = tg.stats()["requests"] - tg_before
+            result["owm_requests"] = owm.stats()["requests"] - owm_before
+            results["scenarios"][name] = result
+            print(f"{name}: {json.dumps(result, ensure_ascii=False)}")
+        db.flush_writes()
+        db.close_conn()
+
+    import metrics
+    if metrics.ENABLED:
+        # Разбивка по операциям (METRICS_ENABLED=1): где именно тратится время в сценариях
+        results["metrics"] = metrics.snapshot()["histograms"]
+
+    tg.stop()
+    owm.stop()
+    return results
+
+
+def compare(current, previous):
+    """Печатает изменение ключевых метрик относительно прошлого прогона."""
+    print(f"Сравнение с {previous.get('commit')} ({previous.get('timestamp')}):")
+    for name, cur in current["scenarios"].items():
+        prev = previous.get("scenarios", {}).get(name)
+        if not prev:
+            continue
+        parts = []
+        for key in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+            if prev.get(key):
+                delta = (cur[key] - prev[key]) / prev[key] * 100
+                parts.append(f"{key} {prev[key]} -> {cur[key]} ({delta:+.1f}%)")
+        print(f"  {name}: " + ", ".join(parts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочные сценарии бота с локальными заглушками")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=90, help="дней истории у пользователей аналитики")
+    parser.add_argument("--click-users", type=int, default=200)
+    parser.add_argument("--clicks", type=int, default=500)
+    parser.add_argument("--city-messages", type=int, default=500)
+    parser.add_argument("--distinct-cities", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--tg-latency", type=float, default=0.03)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-rate", type=float, default=1000, help="лимит отправки сообщений в секунду")
+    parser.add_argument("--owm-latency", type=float, default=0.1)
+    parser.add_argument("--owm-error-rate", type=float, default=0.0)
+    parser.add_argument("--outage-timeout", type=float, default=0.5,
+                        help="таймаут запроса к OWM в сценарии outage (заглушка отвечает вдвое дольше)")
+    parser.add_argument("--output", help="файл результатов (по умолчанию bench/results/<время>_<коммит>.json)")
+    parser.add_argument("--compare", help="прошлый файл результатов для сравнения")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}_{results['commit']}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(results, json.load(f))
@@ -0,0 +1,71 @@
+# Масштабирование воркеров рассылки: сколько уведомлений в секунду доставляют 1, 2, 4... процесса.
+# Запуск: python -m bench.shard_scaling --users 4000 --workers 1 2 4
+import argparse
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+
+import db
+import notify_time
+import worker
+from bench.stubs import FakeBot, fake_weather
+
+
+def seed_due_users(count, locations=200, seed=1):
+    """Создаёт count пользователей с наступившим уведомлением, распределённых по locations точкам."""
+    rnd = random.Random(seed)
+    points = [(rnd.uniform(41, 60), rnd.uniform(20, 60)) for _ in range(locations)]
+    due = (datetime.datetime.utcnow() - datetime.timedelta(minutes=1)).strftime(notify_time.UTC_FORMAT)
+    rows = []
+    for i in range(count):
+        lat, lon = points[i % locations]
+        tg_id = 100000 + i
+        rows.append((tg_id, tg_id, f"City{i % locations}", lat, lon, "Europe/Moscow", 3, due))
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM users")
+        conn.executemany("""
+            INSERT INTO users (tg_id, chat_id, city, lat, lon, timezone, tz_offset, next_notify_utc)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.execute("DELETE FROM notify_leases")
+
+
+def run(users, worker_counts):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, "bench.db")
+        db.init_db()
+        for count in worker_counts:
+            seed_due_users(users)
+            started = time.monotonic()
+            stats = worker.run_workers(count, bot_factory=FakeBot, fetch=fake_weather, until_idle=True,
+                                       global_rate=1e9, db_name=db.DB_NAME)
+            total_wall = time.monotonic() - started
+            # Время доставки считаем от старта первого воркера до завершения последнего, без запуска процессов
+            wall = max(s["finished"] for s in stats) - min(s["started"] for s in stats)
+            sent = sum(s["sent"] for s in stats)
+            results.append({"workers": count, "sent": sent, "wall_time": round(wall, 3),
+                            "total_wall_time": round(total_wall, 3), "per_second": round(sent / wall, 1)})
+    base = results[0]["per_second"] / results[0]["workers"]
+    for r in results:
+        r["efficiency"] = round(r["per_second"] / (base * r["workers"]), 2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=4000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--json", help="куда сохранить результаты")
+    args = parser.parse_args()
+
+    results = run(args.users, args.workers)
+    for r in results:
+        print(f"воркеров {r['workers']}: отправлено {r['sent']} за {r['wall_time']} c — "
+              f"{r['per_second']} сообщ./с (эффективность {r['efficiency']})")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
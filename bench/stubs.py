@@ -0,0 +1,32 @@
+# Заглушки внешних сервисов, работающие внутри процесса (без сети)
+import time
+
+SEND_LATENCY = 0.02
+WEATHER_LATENCY = 0.05
+
+
+class FakeBot:
+    """Вместо telebot.TeleBot: считает сообщения и имитирует задержку Bot API."""
+
+    def __init__(self, latency=SEND_LATENCY):
+        self.latency = latency
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        self.sent += 1
+        return {"chat_id": chat_id, "text": text}
+
+
+def fake_weather(lat, lon):
+    """Вместо weather.get_weather: дождь везде, чтобы уведомление получил каждый пользователь."""
+    time.sleep(WEATHER_LATENCY)
+    return {
+        "temp": 12.0,
+        "temp_min": 10.0,
+        "temp_max": 14.0,
+        "condition": "Rain",
+        "precipitation_type": "rain",
+        "pop": 0,
+        "raw_json": '{"coord": {"lat": %s, "lon": %s}, "dt": 0}' % (lat, lon),
+    }
@@ -0,0 +1,93 @@
+# Генератор синтетических пользователей и истории замеров для weather_bot.db.
+# Запуск: python -m bench.synthetic_users bench.db --users 10000 --days 90
+import argparse
+import datetime
+import random
+
+import db
+import notify_time
+
+# (город, lat, lon, таймзона)
+CITIES = [
+    ("Moscow", 55.7558, 37.6173, "Europe/Moscow"),
+    ("Saint Petersburg", 59.9343, 30.3351, "Europe/Moscow"),
+    ("Kazan", 55.7823, 49.1242, "Europe/Moscow"),
+    ("Novosibirsk", 55.0084, 82.9357, "Asia/Novosibirsk"),
+    ("Yekaterinburg", 56.8389, 60.6057, "Asia/Yekaterinburg"),
+    ("Vladivostok", 43.1155, 131.8855, "Asia/Vladivostok"),
+    ("Rostov-on-Don", 47.2214, 39.7114, "Europe/Moscow"),
+    ("Kaliningrad", 54.7104, 20.4522, "Europe/Kaliningrad"),
+    ("Berlin", 52.5200, 13.4050, "Europe/Berlin"),
+    ("London", 51.5072, -0.1276, "Europe/London"),
+    ("New York", 40.7128, -74.0060, "America/New_York"),
+    ("Chicago", 41.8756, -87.6244, "America/Chicago"),
+    ("Delhi", 28.6139, 77.2090, "Asia/Kolkata"),
+    ("Kathmandu", 27.7172, 85.3240, "Asia/Kathmandu"),
+    ("Tokyo", 35.6762, 139.6503, "Asia/Tokyo"),
+]
+CONDITIONS = ["Clear", "Clouds", "Rain", "Snow", "Drizzle", "Thunderstorm"]
+
+FIRST_TG_ID = 1_000_000
+
+
+def generate_users(count, due_now=False, spread=0.02, seed=1):
+    """
+    Заполняет users. Пользователи распределены по CITIES с разбросом координат spread градусов.
+    due_now — у всех наступило утреннее уведомление (для сценария утренней волны).
+    """
+    rnd = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    due = (now - datetime.timedelta(seconds=30)).strftime(notify_time.UTC_FORMAT)
+    rows = []
+    for i in range(count):
+        city, lat, lon, tz = CITIES[i % len(CITIES)]
+        tg_id = FIRST_TG_ID + i
+        next_notify = due if due_now else notify_time.next_notify_utc(tz)
+        rows.append((tg_id, tg_id, city, lat + rnd.uniform(-spread, spread), lon + rnd.uniform(-spread, spread),
+                     tz, int(notify_time.user_tz(tz).utcoffset(now).total_seconds() // 3600), next_notify))
+    with db.transaction() as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO users (tg_id, chat_id, city, lat, lon, timezone, tz_offset, next_notify_utc)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+    return [r[0] for r in rows]
+
+
+def generate_samples(tg_ids, days=90, per_day=1, seed=2):
+    """Замеры погоды за последние days дней (через обычный путь записи, вместе с дневной сводкой)."""
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    batch = []
+    total = 0
+    for tg_id in tg_ids:
+        for d in range(days):
+            date_str = (today - datetime.timedelta(days=d)).isoformat()
+            for _ in range(per_day):
+                condition = rnd.choice(CONDITIONS)
+                temp = round(rnd.uniform(-15, 30), 1)
+                precipitation = "rain" if condition in ("Rain", "Drizzle") else "snow" if condition == "Snow" else "none"
+                batch.append((tg_id, date_str, temp, temp + 3, temp - 3, condition, precipitation, 0, None))
+        if len(batch) >= 10000:
+            with db.transaction() as conn:
+                db._insert_weather_samples(conn, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        with db.transaction() as conn:
+            db._insert_weather_samples(conn, batch)
+        total += len(batch)
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Синтетические пользователи для нагрузочных тестов")
+    parser.add_argument("db_path")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--due-now", action="store_true")
+    args = parser.parse_args()
+
+    db.DB_NAME = args.db_path
+    db.init_db()
+    ids = generate_users(args.users, due_now=args.due_now)
+    print(f"Пользователей: {len(ids)}, замеров: {generate_samples(ids, args.days)}")
@@ -1,148 +1,192 @@
 import os
 import telebot
-from telebot import types
 from dotenv import load_dotenv
+import charts
+import conversation
 import db
-import requests
-from weather import get_weather
+import export
+import forecast
+import geo
+import messages
+import metrics
+import notifier
+import retention
+import user_cache
+from circuit import CircuitOpenError
+from outbox import Outbox
+from weather_cache import get_weather_cached, weather_cache
 import schedule
+import signal
+import sys
 import time
 import threading
-from timezonefinder import TimezoneFinder
 import datetime
-import pytz
-from sheets import append_rows_to_sheet
+import tempfile
 
 # -------------------- Загрузка токенов --------------------
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
-WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+# Telegram id через запятую: кому доступны команды /stats и /export_all
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 
 bot = telebot.TeleBot(TOKEN)
+# Все исходящие сообщения идут через общую очередь: лимиты Telegram, повторы после 429,
+# ответы пользователям раньше рассылки
+outbox = Outbox(bot)
+
+metrics.register_gauge("weather_cache_size", lambda: weather_cache.stats()["size"])
+metrics.register_gauge("weather_cache_hit_ratio", lambda: weather_cache.stats()["hit_ratio"])
+metrics.register_gauge("chart_cache_bytes", lambda: charts.renderer.stats()["cached_bytes"])
+metrics.register_gauge("db_write_queue_depth", db.write_queue.pending)
+metrics.register_gauge("user_cache_hit_ratio", lambda: user_cache.user_cache.stats()["hit_ratio"])
+metrics.register_gauge("user_cache_revalidate_ratio", lambda: user_cache.user_cache.stats()["revalidate_ratio"])
+metrics.register_gauge("conversation_cache_hit_ratio", lambda: conversation.store.stats()["hit_ratio"])
+metrics.register_gauge("outbox_queue_depth", outbox.queue_depth)
+metrics.register_gauge("outbox_send_rate", outbox.send_rate)
 
 # -------------------- /start --------------------
 @bot.message_handler(commands=['start'])
+@metrics.timed("handler_start")
 def start(message):
     tg_id = message.from_user.id
     chat_id = message.chat.id
 
     # Добавляем пользователя в БД
-    db.add_user(tg_id, chat_id)
+    user_cache.add_user(tg_id, chat_id)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    btn_city = types.KeyboardButton("Выбрать город")
-    btn_weather_today = types.KeyboardButton("Какая сегодня погода?")
-    btn_analytics = types.KeyboardButton("Моя аналитика")
-    markup.add(btn_city, btn_weather_today, btn_analytics)
-
-    bot.send_message(chat_id,
-                     "Привет! Я бот-погодник 🌤\nВыбери действие ниже или напиши город вручную:",
-                     reply_markup=markup)
+    outbox.send_message(chat_id, messages.GREETING, reply_markup=messages.main_keyboard())
 
 # -------------------- /help --------------------
 @bot.message_handler(commands=['help'])
+@metrics.timed("handler_help")
 def help_cmd(message):
     chat_id = message.chat.id
-    bot.send_message(chat_id,
-                     "Команды:\n"
-                     "/start - начать работу с ботом\n"
-                     "/help - помощь\n"
-                     "/setcity - изменить город")
+    outbox.send_message(chat_id, messages.HELP)
+
+# -------------------- /stats (для администраторов) --------------------
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in ADMIN_IDS)
+def stats_cmd(message):
+    outbox.send_message(message.chat.id, metrics.render_text())
+
+# -------------------- /export_all (для администраторов) --------------------
+# /export_all 2025-01-01 2025-03-31 [csv|parquet] — сводка по всем пользователям и городам файлом
+@bot.message_handler(commands=['export_all'], func=lambda message: message.from_user.id in ADMIN_IDS)
+def export_all_cmd(message):
+    args = message.text.split()[1:]
+    fmt = args[2].lower() if len(args) > 2 else "csv"
+    try:
+        date_from, date_to = (datetime.date.fromisoformat(arg) for arg in args[:2])
+    except ValueError:
+        date_from = date_to = None
+    if date_from is None or date_to is None or date_from > date_to or fmt not in export.FORMATS:
+        outbox.send_message(message.chat.id, "Формат: /export_all YYYY-MM-DD YYYY-MM-DD [csv|parquet]")
+        return
+    if fmt == "parquet" and not export.parquet_available():
+        outbox.send_message(message.chat.id, "Parquet недоступен: не установлен pyarrow")
+        return
+    outbox.send_message(message.chat.id, "Готовлю выгрузку, пришлю файлом")
+    # Выгрузка за большой период идёт долго — не занимаем поток обработчиков
+    threading.Thread(target=_export_all, args=(message.chat.id, date_from, date_to, fmt), daemon=True).start()
+
+
+def _export_all(chat_id, date_from, date_to, fmt):
+    name = f"weather_{date_from}_{date_to}.{fmt}"
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = export.export(path, date_from, date_to, fmt=fmt)
+    except Exception as e:
+        os.remove(path)
+        print(f"Ошибка выгрузки {name}: {e}")
+        outbox.send_message(chat_id, "Не удалось подготовить выгрузку")
+        return
+    document = open(path, "rb")
+
+    def cleanup(_):
+        document.close()
+        os.remove(path)
+
+    outbox.send_document(chat_id, document, visible_file_name=name,
+                         caption=f"Строк: {count}").add_done_callback(cleanup)
 
 # -------------------- /setcity --------------------
 @bot.message_handler(commands=['setcity'])
+@metrics.timed("handler_setcity")
 def setcity(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "Напиши название города (например, Moscow):")
-    bot.register_next_step_handler(msg, save_city)
+    # Следующее текстовое сообщение пользователя — название города (в любом процессе с обработчиками)
+    conversation.store.set(message.from_user.id, conversation.AWAITING_CITY)
+    outbox.send_message(chat_id, messages.ASK_CITY)
 
 # -------------------- Сохраняем город --------------------
+@metrics.timed("handler_save_city")
 def save_city(message):
     chat_id = message.chat.id
     tg_id = message.from_user.id
     city_name = message.text.strip()
 
-    url = "http://api.openweathermap.org/geo/1.0/direct"
-    params = {"q": city_name, "limit": 1, "appid": WEATHER_API_KEY}
     try:
-        r = requests.get(url, params=params, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        if not data:
-            bot.send_message(chat_id, "Город не найден 😢 Попробуй ещё раз.")
+        # Известные города берутся из локального кэша, в геокодер идём только за новыми
+        try:
+            city_info = geo.resolve_city(city_name)
+        except CircuitOpenError:
+            # Геокодер недоступен: не ждём таймаут, сразу просим повторить позже
+            outbox.send_message(chat_id, messages.GEOCODER_UNAVAILABLE)
+            return
+        if not city_info:
+            outbox.send_message(chat_id, messages.CITY_NOT_FOUND)
             return
-        city_info = data[0]
         lat = city_info['lat']
         lon = city_info['lon']
         city_name = city_info['name']
-
-        # Определяем таймзону
-        tf = TimezoneFinder()
-        timezone_str = tf.timezone_at(lat=lat, lng=lon)
-
-        # Считаем смещение UTC
-        tz_offset = None
-        if timezone_str:
-            tz = pytz.timezone(timezone_str)
-            tz_offset = int(tz.utcoffset(datetime.datetime.utcnow()).total_seconds() / 3600)
+        timezone_str = city_info['timezone']
+        tz_offset = city_info['tz_offset']
 
         # Сохраняем в базу
-        db.update_city(tg_id, city_name, lat, lon, timezone_str, tz_offset)
+        user_cache.update_city(tg_id, city_name, lat, lon, timezone_str, tz_offset)
+        conversation.store.clear(tg_id)
 
-        bot.send_message(chat_id, f"Город успешно сохранён: {city_name} ✅\n"
-                                  f"Таймзона: {timezone_str}, UTC{tz_offset:+d}")
+        outbox.send_message(chat_id, messages.city_saved(city_name, timezone_str, tz_offset))
 
         # Сразу проверяем погоду и отправляем уведомление
         try:
-            w = get_weather(city_info['lat'], city_info['lon'])
+            # В режиме прогноза предупреждаем по всему сегодняшнему дню, а не по текущему моменту
+            w = (forecast.today_weather(lat, lon, timezone_str, tz_offset) if forecast.FORECAST_MODE
+                 else get_weather_cached(lat, lon))
             today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
 
-            send_msg = None
-            if w['precipitation_type'] in ["rain", "snow"]:
-                send_msg = f"Прогноз на сегодня в {city_info['name']}: {w['condition']} 🌧❄️"
-            elif w['temp_max'] >= 25:
-                send_msg = f"Сегодня в {city_info['name']} жарко 🔥 {w['temp_max']}°C"
-
+            send_msg = messages.city_alert(city_name, w) if w else None
             if send_msg:
-                bot.send_message(chat_id, send_msg)
-                db.save_weather_sample(tg_id, today_str,
-                                       w['temp'], w['temp_max'], w['temp_min'],
-                                       w['condition'], w['precipitation_type'],
-                                       w['pop'], w['raw_json'])
-                db.update_last_notify_date(tg_id, today_str)
+                outbox.send_message(chat_id, send_msg)
+                if not w.get("stale"):
+                    db.save_weather_sample(tg_id, today_str,
+                                           w['temp'], w['temp_max'], w['temp_min'],
+                                           w['condition'], w['precipitation_type'],
+                                           w['pop'], w['raw_json'])
+                user_cache.update_last_notify_date(tg_id, today_str)
 
         except Exception as e:
-            bot.send_message(chat_id, f"Ошибка при проверке погоды: {e}")
+            outbox.send_message(chat_id, f"Ошибка при проверке погоды: {e}")
 
     except Exception as e:
-        bot.send_message(chat_id, f"Ошибка при определении города: {e}")
+        outbox.send_message(chat_id, f"Ошибка при определении города: {e}")
 
 
 # -------------------- Обработка сообщений (кнопки Reply) --------------------
-@bot.message_handler(func=lambda message: True)
-def reply_buttons(message):
-    text = message.text
+@metrics.timed("handler_weather_today")
+def weather_today(message):
     chat_id = message.chat.id
     tg_id = message.from_user.id
+    user = user_cache.get_user(tg_id)
+    if user and user["lat"] and user["lon"]:
+        try:
+            weather = get_weather_cached(user["lat"], user["lon"])
+            today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
 
-    if text == "Выбрать город":
-        setcity(message)
-
-    elif text == "Какая сегодня погода?":
-        user = db.get_user_by_tg_id(tg_id)
-        if user and user["lat"] and user["lon"]:
-            try:
-                weather = get_weather(user["lat"], user["lon"])
-                today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
-
-                msg = (f"Погода сегодня в {user['city']}:\n"
-                       f"{weather['condition']} 🌤\n"
-                       f"Температура: {weather['temp']}°C "
-                       f"(min {weather['temp_min']}°C, max {weather['temp_max']}°C)")
-
-                bot.send_message(chat_id, msg)
+            outbox.send_message(chat_id, messages.weather_today(user['city'], weather))
 
-                # Сохраняем прогноз в БД даже без уведомлений
+            # Сохраняем прогноз в БД даже без уведомлений (устаревший ответ уже сохранён, когда был получен)
+            if not weather.get("stale"):
                 db.save_weather_sample(
                     tg_id,
                     today_str,
@@ -155,149 +199,98 @@ def reply_buttons(message):
                     weather["raw_json"]
                 )
 
-            except Exception as e:
-                bot.send_message(chat_id, f"Ошибка при получении погоды: {e}")
-        else:
-            bot.send_message(chat_id, "Сначала выбери город через кнопку 'Выбрать город'.")
+        except Exception as e:
+            outbox.send_message(chat_id, f"Ошибка при получении погоды: {e}")
+    else:
+        outbox.send_message(chat_id, messages.NEED_CITY)
+
 
+def show_analytics_period(message):
+    outbox.send_message(message.chat.id, messages.CHOOSE_PERIOD, reply_markup=messages.analytics_keyboard())
 
-    elif text == "Моя аналитика":
-        show_analytics_period(message)
 
-    else:
-        save_city(message)
+def unknown_text(message):
+    outbox.send_message(message.chat.id, messages.UNKNOWN_TEXT, reply_markup=messages.main_keyboard())
 
 
-def show_analytics_period(message):
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    # Периоды аналитики
-    markup.add(
-        types.InlineKeyboardButton("Неделя", callback_data="analytics_week"),
-        types.InlineKeyboardButton("Месяц", callback_data="analytics_month"),
-        types.InlineKeyboardButton("Квартал", callback_data="analytics_quarter")
-    )
-    # Кнопка экспорта
-    markup.add(
-        types.InlineKeyboardButton("Экспорт в Google Sheets", callback_data="export_sheets")
-    )
-
-    bot.send_message(
-        message.chat.id,
-        "Выберите период для аналитики или экспортируйте данные:",
-        reply_markup=markup
-    )
+dispatcher = conversation.bot_dispatcher(setcity=setcity, weather_today=weather_today,
+                                        show_analytics_period=show_analytics_period, save_city=save_city,
+                                        fallback=unknown_text)
 
 
+@bot.message_handler(func=lambda message: True)
+@metrics.timed("handler_reply_buttons")
+def reply_buttons(message):
+    dispatcher.resolve(message.from_user.id, message.text)(message)
+
+
+@metrics.timed("morning_notifications")
 def send_daily_notifications():
-    users = db.get_all_users()
-    now_utc = datetime.now(timezone.utc)
-
-    for user in users:
-        tg_id = user["tg_id"]
-        city = user["city"]
-        lat = user["lat"]
-        lon = user["lon"]
-        tz_offset = user["tz_offset"]
-
-        if not city or not lat or not lon or tz_offset is None:
-            continue
-
-        # Локальное время пользователя
-        user_time = now_utc + timedelta(hours=tz_offset)
-
-        # Проверяем: у пользователя сейчас утро (08:00 ± 5 минут)
-        if user_time.hour == 8 and user_time.minute < 5:
-            try:
-                weather = get_weather(lat, lon)
-                today_str = now_utc.strftime("%Y-%m-%d")
-
-                notify = False
-                message = f"Погода в {city} сегодня:\n"
-
-                if weather["precipitation_type"] in ["rain", "snow"]:
-                    notify = True
-                    message += f"❗ Ожидаются осадки: {weather['precipitation_type']}\n"
-
-                if weather["temp_max"] > 25:
-                    notify = True
-                    message += f"🔥 Жара: до {weather['temp_max']}°C\n"
-
-                if notify:
-                    bot.send_message(tg_id, message)
-
-                    # Сохраняем прогноз в БД (важно для аналитики)
-                    db.save_weather_sample(
-                        tg_id,
-                        today_str,
-                        weather["temp"],
-                        weather["temp_max"],
-                        weather["temp_min"],
-                        weather["condition"],
-                        weather["precipitation_type"],
-                        weather["pop"],
-                        weather["raw_json"]
-                    )
-                    db.update_last_notify_date(tg_id, today_str)
-
-            except Exception as e:
-                print(f"Ошибка при отправке уведомления пользователю {tg_id}: {e}")
+    """Утренняя рассылка: выборка пользователей в окне, группировка по локациям, отправка с лимитами."""
+    # Исключение из задачи schedule остановило бы поток планировщика до перезапуска бота,
+    # поэтому ошибка прохода (например, "database is locked") только печатается — следующий тик повторит
+    try:
+        stats = notifier.run_morning_notifications(bot, outbox=outbox)
+        # Погода для тех, у кого утро наступит в ближайшие минуты, — заранее, вне пути доставки
+        notifier.prefetch_upcoming()
+    except Exception as e:
+        print(f"Ошибка утренней рассылки: {e}")
+        return
+    if stats["users"]:
+        print(f"Рассылка: пользователей {stats['users']}, локаций {stats['locations']}, "
+              f"отправлено {stats['sent']}, ошибок {stats['failed']}, "
+              f"время {stats['wall_time']} c, {stats['throughput']} сообщ./с")
 
 def run_scheduled_notifications():
-    schedule.every().day.at("08:00").do(send_daily_notifications, bot=bot)
+    # У каждого пользователя 08:00 наступает в своё время, поэтому проверяем окно каждую минуту
+    schedule.every(1).minutes.do(send_daily_notifications)
 
     while True:
         schedule.run_pending()
         time.sleep(30)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("analytics_"))
+@metrics.timed("handler_analytics")
 def handle_analytics_callback(call):
     tg_id = call.from_user.id
-    user = db.get_user_by_tg_id(tg_id)
+    user = user_cache.get_user(tg_id)
 
     if not user or not user.get("city"):
-        bot.send_message(call.message.chat.id, "Сначала выберите город через кнопку 'Выбрать город'.")
+        outbox.send_message(call.message.chat.id, messages.NEED_CITY_ANALYTICS)
         return
 
     # Определяем период
-    period_map = {
-        "week": "-7 days",
-        "month": "-1 month",
-        "quarter": "-3 months"
-    }
-    period_name_map = {
-        "week": "7 дней",
-        "month": "30 дней",
-        "quarter": "90 дней"
-    }
-
     period_key = call.data.split("_")[1]
-    period = period_map.get(period_key, "-1 month")
-    period_name = period_name_map.get(period_key, "30 дней")
+    period, period_name = messages.ANALYTICS_PERIODS.get(period_key, messages.DEFAULT_PERIOD)
 
     # Получаем данные
     data = db.get_weather_counts(tg_id, user["city"], period)
 
     if not data:
-        bot.send_message(call.message.chat.id, f"Нет данных по городу {user['city']} за {period_name}.")
+        outbox.send_message(call.message.chat.id, f"Нет данных по городу {user['city']} за {period_name}.")
         return
 
     # --- Текстовая статистика ---
-    total = sum(count for _, count in data)
-    text = f"📊 Аналитика погоды для *{user['city']}* за {period_name}:\n\n"
-    for condition, count in data:
-        percent = round(count / total * 100, 1)
-        text += f"- {condition}: {count} дней ({percent}%)\n"
-
-    bot.send_message(call.message.chat.id, text, parse_mode="Markdown")
+    outbox.send_message(call.message.chat.id, messages.analytics_text(user['city'], period_name, data),
+                     parse_mode="Markdown")
 
     # --- Диаграмма ---
-    file_path = db.plot_weather_pie(data, username=str(tg_id), city=user["city"], period=period_name)
-    if file_path:
-        with open(file_path, "rb") as f:
-            bot.send_photo(call.message.chat.id, f)
+    # Рисуется в пуле рендеринга (или берётся из кэша), отправляется по готовности — обработчик не ждёт
+    chat_id = call.message.chat.id
+    future = charts.submit_weather_pie(data, user["city"], period_name)
+    future.add_done_callback(lambda f: _send_chart(chat_id, f))
+
+
+def _send_chart(chat_id, future):
+    try:
+        outbox.send_photo(chat_id, charts.as_photo(future.result()))
+    except Exception as e:
+        print(f"Ошибка при отправке диаграммы в чат {chat_id}: {e}")
 
 def export_weather_to_sheets(tg_id, period="-1 month"):
-    user = db.get_user_by_tg_id(tg_id)
+    from sheets import append_rows_to_sheet  # gspread загружается только при экспорте
+
+    user = user_cache.get_user(tg_id)
     if not user or not user.get("city"):
         return "Сначала выберите город"
 
@@ -315,17 +308,31 @@ def export_weather_to_sheets(tg_id, period="-1 month"):
     return f"Экспорт завершён. Добавлено {len(rows)} строк"
 
 @bot.callback_query_handler(func=lambda call: call.data == "export_sheets")
+@metrics.timed("handler_export")
 def handle_export(call):
-    from sheets import export_weather_to_sheets  # функция из google_sheets.py
-    result = export_weather_to_sheets(call.from_user.id, "-1 month")
-    bot.send_message(call.message.chat.id, result)
+    from sheets import queue_export  # функция из google_sheets.py
+    # Запись в таблицу идёт фоновой очередью, пользователь сразу получает ответ
+    result = queue_export(call.from_user.id, "-1 month")
+    outbox.send_message(call.message.chat.id, result)
 
 # -------------------- Запуск бота --------------------
 if __name__ == "__main__":
     db.init_db()
     print("Бот запущен...")
+    # SIGTERM (docker stop, systemd) — обычный выход: atexit допишет очередь записи в БД и экспорт в Sheets
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # RUN_SCHEDULER=0, если рассылкой занимаются отдельные воркеры (notifier.RUN_SCHEDULER)
+    if notifier.RUN_SCHEDULER:
+        threading.Thread(target=run_scheduled_notifications, daemon=True).start()
+
+    # Свёртка старых замеров и обслуживание базы; RUN_RETENTION=0 — если этим занят другой процесс
+    if os.getenv("RUN_RETENTION", "1") == "1":
+        retention.start()
 
-    threading.Thread(target=run_scheduled_notifications, daemon=True).start()
+    if metrics.ENABLED:
+        metrics.serve()
+        print(f"Метрики: http://0.0.0.0:{metrics.METRICS_PORT}/metrics")
 
     bot.infinity_polling(timeout=60, long_polling_timeout=20)
 
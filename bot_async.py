@@ -0,0 +1,271 @@
+# Асинхронный режим бота: AsyncTeleBot + общая aiohttp-сессия.
+# Медленный ответ OpenWeatherMap блокирует только свой обработчик, а не всех пользователей.
+# Запуск: python bot_async.py
+import asyncio
+import datetime
+import os
+import signal
+import sys
+
+import aiohttp
+import telebot
+from dotenv import load_dotenv
+from telebot.async_telebot import AsyncTeleBot
+
+import charts
+import conversation
+import db
+import forecast
+import geo
+import messages
+import metrics
+import notifier
+import retention
+import user_cache
+from circuit import CircuitOpenError
+from outbox import Outbox
+from weather import get_weather_async
+from weather_cache import weather_cache
+
+# -------------------- Загрузка токенов --------------------
+load_dotenv()
+TOKEN = os.getenv("TELEGRAM_TOKEN")
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Пул соединений к OpenWeatherMap: keep-alive и ограничение числа одновременных подключений
+HTTP_POOL_SIZE = 100
+HTTP_KEEPALIVE = 30
+HTTP_TIMEOUT = 10
+
+bot = AsyncTeleBot(TOKEN)
+# Отправка — как в bot.py, через общую очередь outbox (лимиты Telegram, повторы после 429, приоритет ответов
+# над рассылкой) с синхронным клиентом в её пуле потоков: один лимит на процесс для ответов и рассылки.
+# Постановка в очередь не блокирует цикл событий, обработчики не ждут доставки
+outbox = Outbox(telebot.TeleBot(TOKEN))
+session: aiohttp.ClientSession = None
+
+
+async def get_weather_cached_async(lat, lon):
+    """Погода через общий кэш ячеек (тот же, что у синхронного режима) и общую HTTP-сессию."""
+    return await weather_cache.get_async(lat, lon, lambda a, b: get_weather_async(session, a, b))
+
+
+# -------------------- /start --------------------
+@bot.message_handler(commands=['start'])
+@metrics.timed("handler_start")
+async def start(message):
+    # Добавляем пользователя в БД (SQLite — в отдельном потоке, чтобы не блокировать цикл событий)
+    await asyncio.to_thread(user_cache.add_user, message.from_user.id, message.chat.id)
+    outbox.send_message(message.chat.id, messages.GREETING, reply_markup=messages.main_keyboard())
+
+
+# -------------------- /help --------------------
+@bot.message_handler(commands=['help'])
+@metrics.timed("handler_help")
+async def help_cmd(message):
+    outbox.send_message(message.chat.id, messages.HELP)
+
+
+# -------------------- /stats (для администраторов) --------------------
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in ADMIN_IDS)
+async def stats_cmd(message):
+    outbox.send_message(message.chat.id, metrics.render_text())
+
+
+# -------------------- /setcity --------------------
+@bot.message_handler(commands=['setcity'])
+@metrics.timed("handler_setcity")
+async def setcity(message):
+    # Следующее текстовое сообщение пользователя — название города (в любом процессе с обработчиками)
+    await asyncio.to_thread(conversation.store.set, message.from_user.id, conversation.AWAITING_CITY)
+    outbox.send_message(message.chat.id, messages.ASK_CITY)
+
+
+# -------------------- Сохраняем город --------------------
+@metrics.timed("handler_save_city")
+async def save_city(message):
+    chat_id = message.chat.id
+    tg_id = message.from_user.id
+    city_name = message.text.strip()
+
+    try:
+        # Известные города берутся из локального кэша, в геокодер идём только за новыми
+        try:
+            city_info = await geo.resolve_city_async(session, city_name)
+        except CircuitOpenError:
+            # Геокодер недоступен: не ждём таймаут, сразу просим повторить позже
+            outbox.send_message(chat_id, messages.GEOCODER_UNAVAILABLE)
+            return
+        if not city_info:
+            outbox.send_message(chat_id, messages.CITY_NOT_FOUND)
+            return
+        lat = city_info['lat']
+        lon = city_info['lon']
+        city_name = city_info['name']
+        timezone_str = city_info['timezone']
+        tz_offset = city_info['tz_offset']
+        await asyncio.to_thread(user_cache.update_city, tg_id, city_name, lat, lon, timezone_str, tz_offset)
+        await asyncio.to_thread(conversation.store.clear, tg_id)
+
+        outbox.send_message(chat_id, messages.city_saved(city_name, timezone_str, tz_offset))
+
+        # Сразу проверяем погоду и отправляем уведомление
+        try:
+            # Как в bot.py: в режиме прогноза предупреждаем по всему сегодняшнему дню, а не по текущему моменту
+            if forecast.FORECAST_MODE:
+                w = await asyncio.to_thread(forecast.today_weather, lat, lon, timezone_str, tz_offset)
+            else:
+                w = await get_weather_cached_async(lat, lon)
+            today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
+
+            send_msg = messages.city_alert(city_name, w) if w else None
+            if send_msg:
+                outbox.send_message(chat_id, send_msg)
+                if not w.get("stale"):
+                    db.queue_weather_sample(tg_id, today_str,
+                                            w['temp'], w['temp_max'], w['temp_min'],
+                                            w['condition'], w['precipitation_type'],
+                                            w['pop'], w['raw_json'])
+                await asyncio.to_thread(user_cache.update_last_notify_date, tg_id, today_str)
+
+        except Exception as e:
+            outbox.send_message(chat_id, f"Ошибка при проверке погоды: {e}")
+
+    except Exception as e:
+        outbox.send_message(chat_id, f"Ошибка при определении города: {e}")
+
+
+# -------------------- Обработка сообщений (кнопки Reply) --------------------
+@metrics.timed("handler_weather_today")
+async def weather_today(message):
+    chat_id = message.chat.id
+    tg_id = message.from_user.id
+    user = await asyncio.to_thread(user_cache.get_user, tg_id)
+    if user and user["lat"] and user["lon"]:
+        try:
+            weather = await get_weather_cached_async(user["lat"], user["lon"])
+            today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
+
+            outbox.send_message(chat_id, messages.weather_today(user['city'], weather))
+
+            # Сохраняем прогноз в БД даже без уведомлений (устаревший ответ уже сохранён, когда был получен)
+            if not weather.get("stale"):
+                db.queue_weather_sample(
+                    tg_id,
+                    today_str,
+                    weather["temp"],
+                    weather["temp_max"],
+                    weather["temp_min"],
+                    weather["condition"],
+                    weather["precipitation_type"],
+                    weather["pop"],
+                    weather["raw_json"]
+                )
+
+        except Exception as e:
+            outbox.send_message(chat_id, f"Ошибка при получении погоды: {e}")
+    else:
+        outbox.send_message(chat_id, messages.NEED_CITY)
+
+
+async def show_analytics_period(message):
+    outbox.send_message(message.chat.id, messages.CHOOSE_PERIOD, reply_markup=messages.analytics_keyboard())
+
+
+async def unknown_text(message):
+    outbox.send_message(message.chat.id, messages.UNKNOWN_TEXT, reply_markup=messages.main_keyboard())
+
+
+dispatcher = conversation.bot_dispatcher(setcity=setcity, weather_today=weather_today,
+                                        show_analytics_period=show_analytics_period, save_city=save_city,
+                                        fallback=unknown_text)
+
+
+@bot.message_handler(func=lambda message: True)
+@metrics.timed("handler_reply_buttons")
+async def reply_buttons(message):
+    # Выбор обработчика читает состояние из SQLite — в потоке, чтобы не блокировать цикл событий
+    handler = await asyncio.to_thread(dispatcher.resolve, message.from_user.id, message.text)
+    await handler(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("analytics_"))
+@metrics.timed("handler_analytics")
+async def handle_analytics_callback(call):
+    tg_id = call.from_user.id
+    chat_id = call.message.chat.id
+    user = await asyncio.to_thread(user_cache.get_user, tg_id)
+
+    if not user or not user.get("city"):
+        outbox.send_message(chat_id, messages.NEED_CITY_ANALYTICS)
+        return
+
+    period_key = call.data.split("_")[1]
+    period, period_name = messages.ANALYTICS_PERIODS.get(period_key, messages.DEFAULT_PERIOD)
+
+    data = await asyncio.to_thread(db.get_weather_counts, tg_id, user["city"], period)
+    if not data:
+        outbox.send_message(chat_id, f"Нет данных по городу {user['city']} за {period_name}.")
+        return
+
+    outbox.send_message(chat_id, messages.analytics_text(user['city'], period_name, data),
+                        parse_mode="Markdown")
+
+    # --- Диаграмма ---
+    png = await asyncio.wrap_future(charts.submit_weather_pie(data, user["city"], period_name))
+    outbox.send_photo(chat_id, charts.as_photo(png))
+
+
+@bot.callback_query_handler(func=lambda call: call.data == "export_sheets")
+@metrics.timed("handler_export")
+async def handle_export(call):
+    from sheets import queue_export
+    result = await asyncio.to_thread(queue_export, call.from_user.id, "-1 month")
+    outbox.send_message(call.message.chat.id, result)
+
+
+# -------------------- Утренняя рассылка --------------------
+async def run_scheduled_notifications():
+    # Рассылка использует пул потоков, поэтому целиком уходит в поток; сообщения — в общую очередь outbox
+    while True:
+        try:
+            stats = await asyncio.to_thread(notifier.run_morning_notifications, outbox.bot, outbox=outbox)
+            if stats["users"]:
+                print(f"Рассылка: пользователей {stats['users']}, отправлено {stats['sent']}, "
+                      f"время {stats['wall_time']} c")
+            await asyncio.to_thread(notifier.prefetch_upcoming)
+        except Exception as e:
+            print(f"Ошибка утренней рассылки: {e}")
+        await asyncio.sleep(60)
+
+
+async def main():
+    global session
+    db.init_db()
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE)
+    session = aiohttp.ClientSession(connector=connector,
+                                    timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    # Запуск забирает недоставленные сообщения из таблицы outbox — это запрос к базе, поэтому в потоке
+    await asyncio.to_thread(outbox.start)
+    # RUN_SCHEDULER=0, если рассылкой занимаются отдельные воркеры (notifier.RUN_SCHEDULER)
+    scheduler = asyncio.create_task(run_scheduled_notifications()) if notifier.RUN_SCHEDULER else None
+    # Обслуживание базы идёт в своём потоке: пачки коротких транзакций не блокируют цикл событий
+    if os.getenv("RUN_RETENTION", "1") == "1":
+        retention.start()
+    if metrics.ENABLED:
+        metrics.serve()
+    print("Бот запущен (asyncio)...")
+    try:
+        await bot.infinity_polling(timeout=60, request_timeout=90)
+    finally:
+        if scheduler is not None:
+            scheduler.cancel()
+        await session.close()
+        await asyncio.to_thread(db.flush_writes)
+
+
+# -------------------- Запуск бота --------------------
+if __name__ == "__main__":
+    # SIGTERM (docker stop, systemd) — обычный выход: atexit допишет очередь записи в БД и экспорт в Sheets
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+# Рендер диаграмм аналитики вне потока обработчиков: объектный API matplotlib (без глобального pyplot),
+# PNG в памяти вместо файла в рабочей папке и кэш готовых картинок.
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+# Сколько потоков (или процессов при CHART_PROCESS_POOL=1) рисуют диаграммы
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+CHART_PROCESS_POOL = os.getenv("CHART_PROCESS_POOL") == "1"
+# Суммарный размер PNG в кэше
+CHART_CACHE_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+@metrics.timed("chart_render")
+def render_weather_pie(data, city="Unknown", period="30 дней"):
+    """Круговая диаграмма погоды в PNG (bytes). Не трогает глобальное состояние pyplot."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    conditions, counts = zip(*data)
+
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.pie(counts, labels=conditions, autopct="%1.1f%%", startangle=140)
+    ax.set_title(f"Погода в {city}\nза {period}")
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=100, bbox_inches="tight")
+    return buf.getvalue()
+
+
+def chart_key(data, city, period):
+    """Ключ кэша: хэш данных, города и периода."""
+    raw = repr((sorted(tuple(row) for row in data), city, period)).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class ChartRenderer:
+    """Пул рендеринга с LRU-кэшем PNG, ограниченным по суммарному размеру."""
+
+    def __init__(self, workers=CHART_WORKERS, use_processes=CHART_PROCESS_POOL,
+                 max_bytes=CHART_CACHE_MAX_BYTES):
+        self.workers = workers
+        self.use_processes = use_processes
+        self.max_bytes = max_bytes
+        self._executor = None
+        self._cache = OrderedDict()  # key -> png
+        self._cache_bytes = 0
+        self._pending = {}           # key -> Future, чтобы одинаковые клики не рисовали дважды
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.renders = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            pool_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            self._executor = pool_class(max_workers=self.workers)
+        return self._executor
+
+    def submit(self, data, city, period):
+        """Возвращает Future с PNG. Для закэшированной диаграммы Future уже выполнен."""
+        key = chart_key(data, city, period)
+        with self._lock:
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                metrics.inc("chart_cache_hits")
+                done = Future()
+                done.set_result(png)
+                return done
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+                return pending
+            self.renders += 1
+            future = self._get_executor().submit(render_weather_pie, list(data), city, period)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._finish(key, f))
+        return future
+
+    def _finish(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            png = future.result()
+            if len(png) > self.max_bytes:
+                return
+            self._cache[key] = png
+            self._cache_bytes += len(png)
+            while self._cache_bytes > self.max_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._cache_bytes -= len(old)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "renders": self.renders, "pending": len(self._pending),
+                    "cached": len(self._cache), "cached_bytes": self._cache_bytes}
+
+
+renderer = ChartRenderer()
+
+
+def submit_weather_pie(data, city, period):
+    """Ставит диаграмму в очередь рендеринга (или берёт из кэша). Возвращает concurrent.futures.Future с PNG."""
+    return renderer.submit(data, city, period)
+
+
+def as_photo(png):
+    """PNG-байты в файлоподобный объект для bot.send_photo."""
+    photo = io.BytesIO(png)
+    photo.name = "weather_pie.png"
+    return photo
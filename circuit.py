@@ -0,0 +1,147 @@
+# Предохранитель (circuit breaker) для внешних API: после FAILURE_THRESHOLD ошибок подряд запросы
+# перестают уходить в сеть и сразу завершаются CircuitOpenError, вместо того чтобы каждый ждал таймаут.
+# Пока цепь разомкнута, фоновый поток раз в RECOVERY_TIMEOUT секунд повторяет последний неудачный запрос
+# (полуоткрытое состояние) и замыкает цепь при первом успехе.
+#
+#   breaker = CircuitBreaker("owm")
+#   weather = breaker.call(fetch, lat, lon)
+import os
+import threading
+import time
+
+import metrics
+
+FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+RECOVERY_TIMEOUT = float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлялся: внешний сервис считается недоступным."""
+
+
+def is_upstream_failure(e):
+    """
+    Считается ли ошибка признаком недоступности сервиса: сеть, таймаут, 5xx или 429.
+    Остальные HTTP-ошибки (400, 401, 404) — ответ живого сервиса, цепь из-за них не размыкается.
+    """
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None) or getattr(e, "status", None)
+    if status is None:
+        return True
+    return status >= 500 or status == 429
+
+
+class CircuitBreaker:
+    """Потокобезопасный предохранитель. Состояние видно в метриках как circuit_<name>_state (0/1/2)."""
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, recovery_timeout=RECOVERY_TIMEOUT,
+                 is_failure=is_upstream_failure):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.is_failure = is_failure
+
+        self.state = CLOSED
+        self._failures = 0
+        self._probe_call = None  # (func, args, kwargs) последнего неудачного запроса
+        self._probe_thread = None  # фоновая проверка, пока цепь не замкнута (не больше одной)
+        self._lock = threading.Lock()
+
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+
+        metrics.register_gauge(f"circuit_{name}_state", lambda: _STATE_CODES[self.state])
+
+    def call(self, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) через предохранитель."""
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e, func, *args, **kwargs)
+            raise
+        self.record_success()
+        return result
+
+    def before_call(self):
+        """Бросает CircuitOpenError, если цепь не замкнута. Для асинхронного кода вместе с record_*."""
+        if self.state != CLOSED:
+            with self._lock:
+                self.rejected += 1
+            metrics.inc(f"circuit_{self.name}_rejected")
+            raise CircuitOpenError(f"{self.name}: сервис временно недоступен, запрос не отправлен")
+
+    def record_success(self):
+        if self._failures:
+            with self._lock:
+                self._failures = 0
+
+    def record_failure(self, e, func, *args, **kwargs):
+        """
+        Учитывает ошибку запроса. func(*args, **kwargs) — синхронный вариант этого запроса:
+        его повторяет фоновая проверка, пока цепь разомкнута.
+        """
+        if not self.is_failure(e):
+            self.record_success()
+            return
+        with self._lock:
+            self._failures += 1
+            self._probe_call = (func, args, kwargs)
+            if self.state != CLOSED or self._failures < self.failure_threshold:
+                return
+            self.state = OPEN
+            self.opened += 1
+            # После reset() прежняя проверка могла ещё не проснуться: она и продолжит, второй поток не нужен
+            if self._probe_thread is None:
+                self._probe_thread = threading.Thread(target=self._probe_loop, name=f"circuit-{self.name}",
+                                                      daemon=True)
+                self._probe_thread.start()
+        print(f"Circuit {self.name}: цепь разомкнута после {self._failures} ошибок подряд ({e})")
+        metrics.inc(f"circuit_{self.name}_opened")
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.recovery_timeout)
+            with self._lock:
+                if self.state == CLOSED:
+                    # Цепь замкнута через reset(), проверять больше нечего
+                    self._probe_thread = None
+                    return
+                self.state = HALF_OPEN
+                self.probes += 1
+                func, args, kwargs = self._probe_call
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                if self.is_failure(e):
+                    with self._lock:
+                        self.state = OPEN
+                    continue
+            with self._lock:
+                self.state = CLOSED
+                self._failures = 0
+                self._probe_thread = None
+            print(f"Circuit {self.name}: сервис снова отвечает, цепь замкнута")
+            return
+
+    def reset(self):
+        """Принудительно замыкает цепь (фоновая проверка завершится при следующем пробуждении, без запроса)."""
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "probes": self.probes,
+            }
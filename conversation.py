@@ -0,0 +1,146 @@
+# Диалог с пользователем: таблица маршрутов для текстовых сообщений и хранилище состояния диалога.
+# Состояние ("ждём название города") лежит в таблице conversation_state, поэтому переживает перезапуск
+# и видно всем процессам с обработчиками; перед базой — кэш в памяти с перепроверкой, как в user_cache.py.
+# Для текста вне кнопок пустое состояние из памяти не используется: его всегда подтверждает база.
+#
+#   dispatcher = bot_dispatcher(setcity=setcity, weather_today=weather_today,
+#                               show_analytics_period=show_analytics_period, save_city=save_city,
+#                               fallback=unknown_text)
+#   dispatcher.resolve(tg_id, message.text)(message)
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+import messages
+import metrics
+import user_cache
+
+AWAITING_CITY = "awaiting_city"
+
+# Сколько секунд бот ждёт ответа на вопрос (например, название города после "Выбрать город")
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "3600"))
+# Через сколько секунд состояние из памяти сверяется с базой: его мог изменить другой процесс
+CONVERSATION_REVALIDATE = float(os.getenv("CONVERSATION_REVALIDATE", "2"))
+CONVERSATION_MAX_SIZE = 50000
+
+
+class ConversationStore:
+    """Состояния диалога: запись сквозная (база и память), чтение — из памяти, если сверка была недавно."""
+
+    def __init__(self, ttl=CONVERSATION_TTL, revalidate_after=CONVERSATION_REVALIDATE,
+                 max_size=CONVERSATION_MAX_SIZE):
+        self.ttl = ttl
+        self.revalidate_after = revalidate_after
+        self.max_size = max_size
+        self._entries = OrderedDict()  # tg_id -> (состояние или None, истекает (unix time), когда сверено)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, tg_id, fresh=False):
+        """Текущее состояние или None (бот ничего не ждёт). fresh=True — читать из базы, минуя память."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(tg_id)
+            if not fresh and entry is not None and time.monotonic() - entry[2] < self.revalidate_after:
+                self._entries.move_to_end(tg_id)
+                self.hits += 1
+                return entry[0] if entry[1] > now else None
+            self.loads += 1
+        state = db.get_conversation_state(tg_id, now)
+        # Срок в памяти не важен: запись всё равно сверится с базой через revalidate_after
+        self._put(tg_id, state, now + self.ttl)
+        return state
+
+    def set(self, tg_id, state):
+        expires_at = time.time() + self.ttl
+        db.set_conversation_state(tg_id, state, expires_at)
+        self._put(tg_id, state, expires_at)
+
+    def clear(self, tg_id):
+        db.clear_conversation_state(tg_id)
+        self._put(tg_id, None, 0.0)
+
+    def _put(self, tg_id, state, expires_at):
+        with self._lock:
+            self._entries[tg_id] = (state, expires_at, time.monotonic())
+            self._entries.move_to_end(tg_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.loads
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "loads": self.loads,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+# Общее хранилище процесса
+store = ConversationStore()
+
+
+class Dispatcher:
+    """
+    Маршрутизация текстовых сообщений по таблицам: сначала текст кнопки (buttons), затем состояние диалога
+    (states), иначе fallback. Нажатие кнопки сбрасывает незаконченный диалог. default_state(tg_id) —
+    состояние для пользователя без сохранённого состояния (например, ещё не выбравшего город).
+    Обработчики могут быть и функциями, и корутинами: resolve только выбирает, вызывает сам бот.
+    """
+
+    def __init__(self, buttons, states, fallback, default_state=None, store=store):
+        self.buttons = buttons
+        self.states = states
+        self.fallback = fallback
+        self.default_state = default_state
+        self.store = store
+
+    def resolve(self, tg_id, text):
+        handler = self.buttons.get(text)
+        if handler is not None:
+            if self.store.get(tg_id) is not None:
+                self.store.clear(tg_id)
+            return handler
+        state = self.store.get(tg_id)
+        if state is None:
+            # "Выбрать город" могли нажать в другом процессе: пустое состояние из памяти сверяем с базой,
+            # иначе название города уйдёт в fallback
+            state = self.store.get(tg_id, fresh=True)
+        if state is None and self.default_state is not None:
+            state = self.default_state(tg_id)
+        handler = self.states.get(state)
+        if handler is None:
+            # Сообщение вне диалога: никаких запросов к геокодеру
+            metrics.inc("dispatch_fallback")
+            return self.fallback
+        return handler
+
+
+def default_state(tg_id):
+    """Пока город не выбран, любой текст считается его названием (как предлагает приветствие)."""
+    user = user_cache.get_user(tg_id)
+    return AWAITING_CITY if not user or not user.get("city") else None
+
+
+def bot_dispatcher(setcity, weather_today, show_analytics_period, save_city, fallback, store=store):
+    """
+    Таблица маршрутов бота — одна на bot.py и bot_async.py. Обработчики у каждого режима свои
+    (функции или корутины), кнопки, состояния и default_state — общие.
+    """
+    return Dispatcher(
+        buttons={
+            messages.BTN_CITY: setcity,
+            messages.BTN_WEATHER_TODAY: weather_today,
+            messages.BTN_ANALYTICS: show_analytics_period,
+        },
+        states={AWAITING_CITY: save_city},
+        fallback=fallback,
+        default_state=default_state,
+        store=store,
+    )
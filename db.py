@@ -1,123 +1,358 @@
 import sqlite3
 import os
 import datetime
-import matplotlib
-matplotlib.use('Agg')  # отключает Tkinter и GUI
-import matplotlib.pyplot as plt
+import threading
+import queue
+import time
+import atexit
+import ast
+import hashlib
+import json
+import zlib
+from contextlib import contextmanager
+import metrics
+import notify_time
 
 DB_NAME = "weather_bot.db"
 
+# Параметры подключения: ожидание блокировки и размер страничного кэша (в КиБ, отрицательное значение)
+BUSY_TIMEOUT = 30
+CACHE_SIZE_KB = 16000
+
+# Параметры отложенной записи
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_INTERVAL = 1.0
+# Если пачка не записалась, каждый вид записи повторяется отдельно: столько раз, с паузой 0.5, 1, 2 c
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY = 0.5
+
+# Выгрузка сводки: сколько строк читать за раз и сколько дней агрегировать одним запросом
+EXPORT_BATCH_SIZE = 5000
+EXPORT_DAYS_PER_QUERY = 7
+
+_local = threading.local()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT)
+    # WAL позволяет читать во время записи и убирает большую часть "database is locked"
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
 
 def get_conn():
-    """Создаёт подключение к базе SQLite."""
-    return sqlite3.connect(DB_NAME)
+    """Возвращает постоянное подключение к базе SQLite для текущего потока."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.db_name != DB_NAME:
+        if conn is not None:
+            conn.close()
+        conn = _connect()
+        _local.conn = conn
+        _local.db_name = DB_NAME
+    return conn
+
+
+def close_conn():
+    """Закрывает подключение текущего потока (например, при завершении воркера)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction():
+    """Транзакция на подключении текущего потока: commit при успехе, rollback при ошибке."""
+    conn = get_conn()
+    with conn:
+        yield conn
+
+
+# Колонки, добавленные после первой версии схемы: (таблица, колонка, тип).
+# В существующие базы добавляются до выполнения db_init.sql, чтобы индексы по ним создались.
+COLUMN_MIGRATIONS = [
+    ("users", "next_notify_utc", "TEXT"),
+    ("weather_samples", "payload_hash", "TEXT"),
+    ("users", "version", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def _migrate_columns(conn):
+    for table, column, column_type in COLUMN_MIGRATIONS:
+        existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if existing and column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def _backfill_next_notify(conn):
+    """Проставляет next_notify_utc пользователям с городом, у которых его ещё нет."""
+    rows = conn.execute("""
+        SELECT tg_id, timezone, tz_offset FROM users
+        WHERE next_notify_utc IS NULL AND city IS NOT NULL
+          AND (timezone IS NOT NULL OR tz_offset IS NOT NULL)
+    """).fetchall()
+    updates = [(notify_time.next_notify_utc(timezone, tz_offset), tg_id) for tg_id, timezone, tz_offset in rows]
+    conn.executemany("UPDATE users SET next_notify_utc = ?, version = version + 1 WHERE tg_id = ?", updates)
+
+
+def _backfill_weather_daily(conn):
+    """Один раз строит дневную сводку из уже накопленных замеров (последний замер дня побеждает)."""
+    if conn.execute("SELECT 1 FROM weather_daily LIMIT 1").fetchone():
+        return
+    conn.execute("""
+        INSERT OR REPLACE INTO weather_daily (tg_id, city, date, condition)
+        SELECT ws.tg_id, u.city, ws.date, ws.condition
+        FROM weather_samples ws
+        JOIN users u ON ws.tg_id = u.tg_id
+        WHERE u.city IS NOT NULL AND ws.date IS NOT NULL AND ws.condition IS NOT NULL
+        ORDER BY ws.id
+    """)
 
 
 def init_db():
-    """Создаёт таблицы из db_init.sql."""
+    """Создаёт таблицы из db_init.sql и доводит существующую базу до актуальной схемы."""
     script_path = os.path.join(os.path.dirname(__file__), "db_init.sql")
     with open(script_path, "r", encoding="utf-8") as f:
         sql = f.read()
 
     conn = get_conn()
-    try:
-        conn.executescript(sql)
-        conn.commit()
-        print("✅ База и таблицы инициализированы")
-    finally:
-        conn.close()
+    if not conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        # Новая база: место от удалённых строк возвращается по частям (retention.py, PRAGMA incremental_vacuum).
+        # Режим меняется только через VACUUM, на пустой базе он мгновенный
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    with conn:
+        _migrate_columns(conn)
+    conn.executescript(sql)
+    with conn:
+        _backfill_next_notify(conn)
+        _backfill_weather_daily(conn)
+    print("✅ База и таблицы инициализированы")
+
+# Каждое изменение строки users увеличивает version: по нему кэши других процессов (user_cache.py)
+# понимают, что их копия устарела
+def _user_version(conn, tg_id):
+    row = conn.execute("SELECT version FROM users WHERE tg_id = ?", (tg_id,)).fetchone()
+    return row[0] if row else None
 
+
+@metrics.timed("db_add_user")
 def add_user(tg_id: int, chat_id: int):
-    """Добавить пользователя, если его ещё нет в базе."""
-    conn = get_conn()
-    try:
+    """Добавить пользователя, если его ещё нет в базе. Возвращает версию строки."""
+    with transaction() as conn:
         conn.execute("""
             INSERT OR IGNORE INTO users (tg_id, chat_id)
             VALUES (?, ?)
         """, (tg_id, chat_id))
-        conn.commit()
-    finally:
-        conn.close()
+        return _user_version(conn, tg_id)
 
 
+@metrics.timed("db_get_user_version")
+def get_user_version(tg_id: int):
+    """Текущая версия строки пользователя или None, если его нет."""
+    return _user_version(get_conn(), tg_id)
+
+
+@metrics.timed("db_get_user")
 def get_user(tg_id: int):
     """Получить данные пользователя по tg_id."""
-    conn = get_conn()
-    try:
-        cur = conn.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
-        return cur.fetchone()
-    finally:
-        conn.close()
+    cur = get_conn().execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
+    return cur.fetchone()
 
 
+@metrics.timed("db_update_city")
 def update_city(tg_id: int, city: str, lat: float, lon: float, timezone: str = None, tz_offset: int = None):
-    """Обновить город пользователя."""
-    conn = get_conn()
-    try:
+    """
+    Обновить город пользователя и пересчитать момент следующего уведомления.
+    Возвращает (next_notify_utc, версия строки).
+    """
+    next_notify = notify_time.next_notify_utc(timezone, tz_offset)
+    with transaction() as conn:
         conn.execute("""
             UPDATE users
-            SET city = ?, lat = ?, lon = ?, timezone = ?, tz_offset = ?
+            SET city = ?, lat = ?, lon = ?, timezone = ?, tz_offset = ?, next_notify_utc = ?,
+                version = version + 1
             WHERE tg_id = ?
-        """, (city, lat, lon, timezone, tz_offset, tg_id))
-        conn.commit()
-    finally:
-        conn.close()
+        """, (city, lat, lon, timezone, tz_offset, next_notify, tg_id))
+        return next_notify, _user_version(conn, tg_id)
 
 def get_all_users():
     """Возвращает список всех пользователей в виде словарей."""
-    conn = get_conn()
-    try:
-        cur = conn.execute("SELECT * FROM users")
-        columns = [column[0] for column in cur.description]
-        rows = cur.fetchall()
-        # Преобразуем в список словарей
-        return [dict(zip(columns, row)) for row in rows]
-    finally:
-        conn.close()
+    cur = get_conn().execute("SELECT * FROM users")
+    columns = [column[0] for column in cur.description]
+    rows = cur.fetchall()
+    # Преобразуем в список словарей
+    return [dict(zip(columns, row)) for row in rows]
+
+@metrics.timed("db_get_due_users")
+def get_due_users(now_utc: str, limit: int = 10000, shard: int = None, shards: int = None):
+    """
+    Пользователи, чьё следующее уведомление наступило (next_notify_utc <= now_utc).
+    Диапазонный запрос по индексу idx_users_next_notify: стоимость зависит от числа должников, а не от всех пользователей.
+    shard/shards — взять только пользователей своего шарда (tg_id % shards = shard).
+    """
+    shard_filter = "AND tg_id % ? = ?" if shards else ""
+    params = (now_utc, shards, shard, limit) if shards else (now_utc, limit)
+    cur = get_conn().execute(f"""
+        SELECT tg_id, chat_id, city, lat, lon, timezone, tz_offset, next_notify_utc, last_notify_date
+        FROM users
+        WHERE next_notify_utc <= ?
+          AND notify_morning = 1
+          AND lat IS NOT NULL AND lon IS NOT NULL
+          {shard_filter}
+        ORDER BY next_notify_utc
+        LIMIT ?
+    """, params)
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+@metrics.timed("db_get_upcoming_locations")
+def get_upcoming_locations(after_utc: str, until_utc: str, shard: int = None, shards: int = None):
+    """
+    Координаты пользователей, чьё уведомление наступит в интервале (after_utc, until_utc] — для предзагрузки погоды.
+    Тот же индекс idx_users_next_notify, что и у get_due_users.
+    """
+    shard_filter = "AND tg_id % ? = ?" if shards else ""
+    params = (after_utc, until_utc, shards, shard) if shards else (after_utc, until_utc)
+    cur = get_conn().execute(f"""
+        SELECT DISTINCT lat, lon
+        FROM users
+        WHERE next_notify_utc > ? AND next_notify_utc <= ?
+          AND notify_morning = 1
+          AND lat IS NOT NULL AND lon IS NOT NULL
+          {shard_filter}
+    """, params)
+    return cur.fetchall()
+
+@metrics.timed("db_claim_shard")
+def claim_shard(shard: int, owner: str, ttl: float):
+    """
+    Берёт или продлевает аренду шарда. Успешно, если шард свободен, уже наш или аренда истекла.
+    Upsert атомарен, поэтому за истёкший шард из двух воркеров победит один.
+    """
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO notify_leases (shard, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(shard) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE notify_leases.owner = excluded.owner OR notify_leases.expires_at < ?
+        """, (shard, owner, now + ttl, now))
+        row = conn.execute("SELECT owner FROM notify_leases WHERE shard = ?", (shard,)).fetchone()
+    return row is not None and row[0] == owner
+
+
+def release_shard(shard: int, owner: str):
+    """Отпускает аренду шарда, если она наша (другой воркер сможет забрать его сразу)."""
+    with transaction() as conn:
+        conn.execute("UPDATE notify_leases SET expires_at = 0 WHERE shard = ? AND owner = ?", (shard, owner))
+
 
+def _advance_next_notify(conn, rows):
+    """rows — кортежи (next_notify_utc, last_notify_date, tg_id)."""
+    conn.executemany("""
+        UPDATE users SET next_notify_utc = ?, last_notify_date = ?, version = version + 1 WHERE tg_id = ?
+    """, rows)
+
+
+def advance_next_notify(rows):
+    """Сразу (не через очередь записи) переносит уведомления: rows — (next_notify_utc, last_notify_date, tg_id)."""
+    with transaction() as conn:
+        _advance_next_notify(conn, rows)
+
+
+def _update_last_notify_dates(conn, rows):
+    conn.executemany("UPDATE users SET last_notify_date = ?, version = version + 1 WHERE tg_id = ?", rows)
+
+
+@metrics.timed("db_update_last_notify_date")
 def update_last_notify_date(tg_id, date_str):
-    """Обновляет last_notify_date пользователя."""
-    conn = get_conn()
+    """Обновляет last_notify_date пользователя. Возвращает версию строки."""
+    with transaction() as conn:
+        _update_last_notify_dates(conn, [(date_str, tg_id)])
+        return _user_version(conn, tg_id)
+
+
+# -------------------- Сжатое хранение ответов API --------------------
+def _parse_payload(raw):
+    """Ответ API из строки: JSON или (в старых записях) repr питоновского словаря."""
     try:
-        conn.execute(
-            "UPDATE users SET last_notify_date = ? WHERE tg_id = ?",
-            (date_str, tg_id)
-        )
-        conn.commit()
-    finally:
-        conn.close()
+        return json.loads(raw)
+    except ValueError:
+        return ast.literal_eval(raw)
+
+
+def _pack_payload(raw):
+    """Строка ответа -> (hash, lat, lon, dt, сжатый канонический JSON)."""
+    data = _parse_payload(raw)
+    canonical = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    # У ответа /forecast координаты лежат в city, а время — у каждого слота
+    coord = data.get("coord") or (data.get("city") or {}).get("coord") or {}
+    dt = data.get("dt") or next((slot.get("dt") for slot in data.get("list") or []), None)
+    return (hashlib.sha256(canonical).hexdigest(), coord.get("lat"), coord.get("lon"),
+            dt, zlib.compress(canonical, 9))
+
+
+def _store_payloads(conn, raws):
+    """Сохраняет ответы в weather_payloads (повторы пропускаются). Возвращает словарь raw -> hash."""
+    packed = {}
+    for raw in raws:
+        if raw and raw not in packed:
+            packed[raw] = _pack_payload(raw)
+    conn.executemany("""
+        INSERT OR IGNORE INTO weather_payloads (hash, lat, lon, dt, data)
+        VALUES (?, ?, ?, ?, ?)
+    """, packed.values())
+    return {raw: p[0] for raw, p in packed.items()}
 
 
+def get_payload(payload_hash):
+    """Исходный ответ API (словарь) по хэшу или None."""
+    row = get_conn().execute("SELECT data FROM weather_payloads WHERE hash = ?", (payload_hash,)).fetchone()
+    return json.loads(zlib.decompress(row[0])) if row else None
+
+
+def _insert_weather_samples(conn, rows):
+    """rows — кортежи (tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, raw_json)."""
+    hashes = _store_payloads(conn, [row[8] for row in rows])
+    conn.executemany("""
+        INSERT INTO weather_samples
+        (tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, payload_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [row[:8] + (hashes.get(row[8]),) for row in rows])
+    # Инкрементально обновляем дневную сводку: один день — одно состояние для текущего города пользователя
+    conn.executemany("""
+        INSERT INTO weather_daily (tg_id, city, date, condition)
+        SELECT tg_id, city, ?, ? FROM users WHERE tg_id = ? AND city IS NOT NULL
+        ON CONFLICT(tg_id, city, date) DO UPDATE SET condition = excluded.condition
+    """, [(row[1], row[5], row[0]) for row in rows if row[1] and row[5]])
+
+
+@metrics.timed("db_save_weather_sample")
 def save_weather_sample(tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, raw_json):
     """Сохраняет погодный прогноз в weather_samples."""
-    conn = get_conn()
-    try:
-        conn.execute("""
-            INSERT INTO weather_samples
-            (tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, raw_json)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, raw_json))
-        conn.commit()
-    finally:
-        conn.close()
+    with transaction() as conn:
+        _insert_weather_samples(conn, [(tg_id, date, temp, temp_max, temp_min,
+                                        condition, precipitation_type, pop, raw_json)])
 
+@metrics.timed("db_get_user_by_tg_id")
 def get_user_by_tg_id(tg_id):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row  # чтобы возвращать словарь
-    c = conn.cursor()
+    c = get_conn().cursor()
+    c.row_factory = sqlite3.Row  # чтобы возвращать словарь
 
     c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
     row = c.fetchone()
 
-    conn.close()
-
     if row:
         return dict(row)
     return None
 
+@metrics.timed("db_get_weather_counts")
 def get_weather_counts(tg_id, city, period):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    c = get_conn().cursor()
 
     today = datetime.date.today()
     if period == "-7 days":
@@ -127,22 +362,298 @@ def get_weather_counts(tg_id, city, period):
     elif period == "-3 months":
         start_date = today - datetime.timedelta(days=90)
 
+    # Читаем дневную сводку: O(дней в периоде) по первичному ключу, независимо от числа замеров
     c.execute("""
-        SELECT ws.condition, COUNT(*)
-        FROM weather_samples ws
-        JOIN users u ON ws.tg_id = u.tg_id
-        WHERE ws.tg_id = ? AND u.city = ? AND ws.date BETWEEN ? AND ?
-        GROUP BY ws.condition
+        SELECT condition, COUNT(*)
+        FROM weather_daily
+        WHERE tg_id = ? AND city = ? AND date BETWEEN ? AND ?
+        GROUP BY condition
     """, (tg_id, city, str(start_date), str(today)))
 
-    result = c.fetchall()
-    conn.close()
-    return result
+    return c.fetchall()
+
+
+AGGREGATE_COLUMNS = ("date", "city", "condition", "samples", "users", "temp_avg", "temp_min", "temp_max", "pop_max")
+
 
+def iter_weather_aggregates(date_from, date_to, city=None, batch_size=EXPORT_BATCH_SIZE,
+                            days_per_query=EXPORT_DAYS_PER_QUERY):
+    """
+    Сводка замеров по всем пользователям за [date_from, date_to]: строки AGGREGATE_COLUMNS
+    (день, город, состояние, число замеров и пользователей, температуры), пачками по batch_size.
+    Группировка идёт в SQLite окнами по days_per_query дней, поэтому ни база, ни Python
+    не держат в памяти больше одного окна, сколько бы миллионов замеров ни было в диапазоне.
+    """
+    start = datetime.date.fromisoformat(str(date_from))
+    end = datetime.date.fromisoformat(str(date_to))
+    city_filter = "AND u.city = ?" if city else ""
+    sql = f"""
+        SELECT ws.date, u.city, ws.condition, COUNT(*), COUNT(DISTINCT ws.tg_id),
+               ROUND(AVG(ws.temp), 2), MIN(ws.temp_min), MAX(ws.temp_max), MAX(ws.pop)
+        FROM weather_samples ws
+        JOIN users u ON u.tg_id = ws.tg_id
+        WHERE ws.date >= ? AND ws.date < ? AND u.city IS NOT NULL {city_filter}
+        GROUP BY ws.date, u.city, ws.condition
+        ORDER BY ws.date, u.city, ws.condition
+    """
+    # Отдельное соединение: генератор читается долго, а соединение потока может понадобиться для записи
+    conn = _connect()
+    try:
+        while start <= end:
+            stop = min(start + datetime.timedelta(days=days_per_query), end + datetime.timedelta(days=1))
+            params = (str(start), str(stop)) + ((city,) if city else ())
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+            start = stop
+    finally:
+        conn.close()
+
+
+@metrics.timed("db_get_geocode")
+def get_geocode(query: str):
+    """Город из локального кэша геокодера по нормализованному названию или None."""
+    c = get_conn().cursor()
+    c.row_factory = sqlite3.Row
+    c.execute("SELECT name, lat, lon, timezone FROM geocode_cache WHERE query = ?", (query,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+
+def save_geocodes(rows):
+    """rows — кортежи (query, name, lat, lon, timezone). Перезаписывает существующие записи."""
+    with transaction() as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO geocode_cache (query, name, lat, lon, timezone)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+
+
+# -------------------- Состояние диалога (conversation.py) --------------------
+@metrics.timed("db_get_conversation_state")
+def get_conversation_state(tg_id, now):
+    """Состояние диалога пользователя или None, если его нет или оно истекло (now — unix time)."""
+    row = get_conn().execute("SELECT state FROM conversation_state WHERE tg_id = ? AND expires_at > ?",
+                             (tg_id, now)).fetchone()
+    return row[0] if row else None
+
+
+def set_conversation_state(tg_id, state, expires_at):
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO conversation_state (tg_id, state, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(tg_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+        """, (tg_id, state, expires_at))
+
+
+def clear_conversation_state(tg_id):
+    with transaction() as conn:
+        conn.execute("DELETE FROM conversation_state WHERE tg_id = ?", (tg_id,))
+
+
+def prune_conversation_states(now):
+    """Удаляет истёкшие состояния диалога. Возвращает число удалённых строк."""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,)).rowcount
+
+
+# -------------------- Исходящие уведомления --------------------
+def add_outbox_messages(rows, owner, advance=()):
+    """
+    rows — кортежи (chat_id, text, kwargs_json, priority). Возвращает id строк в том же порядке.
+    advance — кортежи (next_notify_utc, last_notify_date, tg_id): перенос уведомлений в той же транзакции,
+    чтобы после падения или потери аренды шарда никто не получил утреннее сообщение дважды.
+    """
+    now = time.time()
+    with transaction() as conn:
+        ids = [conn.execute("""
+            INSERT INTO outbox (chat_id, text, kwargs, priority, owner, claimed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (chat_id, text, kwargs, priority, owner, now)).lastrowid
+               for chat_id, text, kwargs, priority in rows]
+        _advance_next_notify(conn, advance)
+    return ids
+
+
+def claim_outbox(owner, stale_before):
+    """
+    Забирает недоставленные сообщения, владелец которых не подтверждал их с stale_before (упал или перезапущен).
+    Возвращает только что забранные строки: кортежи (id, chat_id, text, kwargs_json, priority).
+    """
+    # Сначала помечаем строки временной меткой: UPDATE берёт блокировку записи,
+    # поэтому две копии бота не заберут одни и те же строки
+    token = f"{owner}#claim"
+    with transaction() as conn:
+        conn.execute("UPDATE outbox SET owner = ?, claimed_at = ? WHERE claimed_at < ? AND owner IS NOT ?",
+                     (token, time.time(), stale_before, owner))
+        rows = conn.execute("""
+            SELECT id, chat_id, text, kwargs, priority FROM outbox WHERE owner = ? ORDER BY id
+        """, (token,)).fetchall()
+        conn.execute("UPDATE outbox SET owner = ? WHERE owner = ?", (owner, token))
+    return rows
+
+
+def touch_outbox(owner):
+    """Подтверждает, что владелец жив и его сообщения забирать не нужно."""
+    with transaction() as conn:
+        conn.execute("UPDATE outbox SET claimed_at = ? WHERE owner = ?", (time.time(), owner))
+
+
+def _delete_outbox(conn, ids):
+    conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+
+# -------------------- Отложенная пакетная запись --------------------
+# Вид записи в очереди -> функция, пишущая пачку таких строк
+_BATCH_WRITERS = {
+    "sample": _insert_weather_samples,
+    "notify": _update_last_notify_dates,
+    "advance": _advance_next_notify,
+    "outbox_done": _delete_outbox,
+}
+
+
+class WriteBehindQueue:
+    """
+    Очередь записи: замеры погоды и даты уведомлений копятся в памяти и пишутся
+    фоновым потоком одной транзакцией через executemany.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def put_sample(self, row):
+        self._ensure_started()
+        self._queue.put(("sample", row))
+
+    def put_last_notify_date(self, tg_id, date_str):
+        self._ensure_started()
+        self._queue.put(("notify", (date_str, tg_id)))
+
+    def put_advance(self, tg_id, next_notify_utc, date_str):
+        self._ensure_started()
+        self._queue.put(("advance", (next_notify_utc, date_str, tg_id)))
+
+    def put_outbox_done(self, outbox_id):
+        self._ensure_started()
+        self._queue.put(("outbox_done", outbox_id))
+
+    def pending(self):
+        """Сколько записей ждёт фонового потока (для метрик)."""
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """Блокирует, пока всё поставленное до вызова не записано в базу."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # Собираем пачку, пока не наберётся batch_size, не истечёт интервал или не попросят flush
+            while len(batch) < self.batch_size and batch[-1][0] != "flush":
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    @metrics.timed("db_write_batch")
+    def _write(self, batch):
+        groups = [(kind, [row for k, row in batch if k == kind]) for kind in _BATCH_WRITERS]
+        groups = [(kind, rows) for kind, rows in groups if rows]
+        try:
+            if groups:
+                try:
+                    with transaction() as conn:
+                        for kind, rows in groups:
+                            _BATCH_WRITERS[kind](conn, rows)
+                except Exception as e:
+                    print(f"Ошибка пакетной записи в БД ({', '.join(f'{k}: {len(rows)}' for k, rows in groups)}): "
+                          f"{e}; пишем по видам с повторами")
+                    # Ошибка в одном виде (например, в замерах) не должна отменять остальные —
+                    # прежде всего удаление доставленных сообщений из outbox, иначе они уйдут повторно
+                    for kind, rows in groups:
+                        self._write_kind(kind, rows)
+        finally:
+            for kind, payload in batch:
+                if kind == "flush":
+                    payload.set()
+
+    def _write_kind(self, kind, rows):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                with transaction() as conn:
+                    _BATCH_WRITERS[kind](conn, rows)
+                return
+            except Exception as e:
+                error = e
+                time.sleep(WRITE_RETRY_DELAY * 2 ** attempt)
+        if kind == "outbox_done":
+            # Удаление повторять безопасно: возвращаем в очередь до следующей пачки
+            print(f"Не удалось отметить доставку {len(rows)} сообщений outbox ({error}), повторим позже")
+            for row in rows:
+                self._queue.put((kind, row))
+            return
+        print(f"Пачка {kind} ({len(rows)} строк) не записана после {WRITE_RETRIES} попыток: {error}")
+
+
+write_queue = WriteBehindQueue()
+
+
+def queue_weather_sample(tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, raw_json):
+    """Как save_weather_sample, но запись выполняется фоновым потоком пачкой."""
+    write_queue.put_sample((tg_id, date, temp, temp_max, temp_min, condition, precipitation_type, pop, raw_json))
+
+
+def queue_last_notify_date(tg_id, date_str):
+    """Как update_last_notify_date, но запись выполняется фоновым потоком пачкой."""
+    write_queue.put_last_notify_date(tg_id, date_str)
+
+
+def queue_advance_next_notify(tg_id, next_notify_utc, date_str):
+    """Переносит уведомление пользователя на следующий день и отмечает дату отправки (пакетно)."""
+    write_queue.put_advance(tg_id, next_notify_utc, date_str)
+
+
+def flush_writes(timeout=None):
+    """Дожидается записи всех отложенных операций."""
+    return write_queue.flush(timeout)
+
+
+atexit.register(flush_writes, 5)
+
+@metrics.timed("plot_weather_pie")
 def plot_weather_pie(data, username="user", city="Unknown", period="30 дней"):
     if not data:
         return None
 
+    # matplotlib загружается только здесь: процессам рассылки он не нужен
+    import matplotlib
+    matplotlib.use('Agg')  # отключает Tkinter и GUI
+    import matplotlib.pyplot as plt
+
     conditions, counts = zip(*data)
 
     plt.figure(figsize=(6,6))
@@ -156,5 +667,139 @@ def plot_weather_pie(data, username="user", city="Unknown", period="30 дней"
     return file_path
 
 
+def migrate_raw_payloads(batch_size=1000, vacuum=True):
+    """
+    Переносит raw_json старых замеров в weather_payloads и очищает колонку.
+    Работает пачками по id (без повторного просмотра уже перенесённых строк), чтобы не держать
+    долгую блокировку записи. Возвращает число перенесённых строк.
+    """
+    conn = get_conn()
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, raw_json FROM weather_samples
+            WHERE id > ? AND raw_json IS NOT NULL
+            ORDER BY id
+            LIMIT ?
+        """, (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        with conn:
+            hashes = {}
+            for row_id, raw in rows:
+                try:
+                    hashes.update(_store_payloads(conn, [raw]))
+                except (ValueError, SyntaxError):
+                    # raw_json остаётся на месте: это единственная копия ответа
+                    print(f"Не удалось разобрать raw_json замера {row_id}, оставляем его как есть")
+            done = [(hashes[raw], row_id) for row_id, raw in rows if raw in hashes]
+            conn.executemany("UPDATE weather_samples SET payload_hash = ?, raw_json = NULL WHERE id = ?", done)
+        migrated += len(done)
+    if vacuum and migrated:
+        conn.execute("VACUUM")
+    return migrated
+
+
+# -------------------- Хранение и обслуживание (retention.py) --------------------
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def roll_up_samples(cutoff_date, batch_size):
+    """
+    Сворачивает до batch_size замеров с датой раньше cutoff_date в weather_monthly и удаляет их вместе
+    с ответами API, на которые больше никто не ссылается. Одна короткая транзакция. Возвращает число замеров.
+    """
+    conn = get_conn()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS retention_batch (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS retention_payloads (hash TEXT PRIMARY KEY)")
+    with transaction() as conn:
+        conn.execute("DELETE FROM retention_batch")
+        conn.execute("DELETE FROM retention_payloads")
+        count = conn.execute("""
+            INSERT INTO retention_batch (id)
+            SELECT id FROM weather_samples WHERE date < ? LIMIT ?
+        """, (str(cutoff_date), batch_size)).rowcount
+        if not count:
+            return 0
+        conn.execute("""
+            INSERT INTO weather_monthly (tg_id, city, month, condition, samples, temp_sum, temp_min, temp_max)
+            SELECT ws.tg_id, COALESCE(u.city, ''), substr(ws.date, 1, 7), COALESCE(ws.condition, ''),
+                   COUNT(*), SUM(ws.temp), MIN(ws.temp_min), MAX(ws.temp_max)
+            FROM retention_batch b
+            CROSS JOIN weather_samples ws ON ws.id = b.id  -- CROSS JOIN: от пачки к замерам, без скана weather_samples
+            LEFT JOIN users u ON u.tg_id = ws.tg_id
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT(tg_id, city, month, condition) DO UPDATE SET
+                samples = samples + excluded.samples,
+                temp_sum = COALESCE(temp_sum, 0) + COALESCE(excluded.temp_sum, 0),
+                temp_min = MIN(COALESCE(temp_min, excluded.temp_min), COALESCE(excluded.temp_min, temp_min)),
+                temp_max = MAX(COALESCE(temp_max, excluded.temp_max), COALESCE(excluded.temp_max, temp_max))
+        """)
+        conn.execute("""
+            INSERT OR IGNORE INTO retention_payloads (hash)
+            SELECT ws.payload_hash FROM retention_batch b
+            CROSS JOIN weather_samples ws ON ws.id = b.id
+            WHERE ws.payload_hash IS NOT NULL
+        """)
+        conn.execute("DELETE FROM weather_samples WHERE id IN (SELECT id FROM retention_batch)")
+        conn.execute("""
+            DELETE FROM weather_payloads
+            WHERE hash IN (SELECT hash FROM retention_payloads)
+              AND NOT EXISTS (SELECT 1 FROM weather_samples WHERE payload_hash = weather_payloads.hash)
+        """)
+    return count
+
+
+def prune_weather_daily(cutoff_date, batch_size):
+    """Удаляет до batch_size строк дневной сводки раньше cutoff_date. Возвращает число удалённых строк."""
+    with transaction() as conn:
+        return conn.execute("""
+            DELETE FROM weather_daily
+            WHERE (tg_id, city, date) IN (
+                SELECT tg_id, city, date FROM weather_daily WHERE date < ? LIMIT ?
+            )
+        """, (str(cutoff_date), batch_size)).rowcount
+
+
+def auto_vacuum_mode():
+    return get_conn().execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def free_pages():
+    return get_conn().execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def incremental_vacuum(pages):
+    """Возвращает системе до pages свободных страниц. Работает только в режиме auto_vacuum=INCREMENTAL."""
+    conn = get_conn()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+
+
+def analyze(limit):
+    """Обновляет статистику планировщика. analysis_limit ограничивает число строк, читаемых на индекс."""
+    conn = get_conn()
+    conn.execute(f"PRAGMA analysis_limit={int(limit)}")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+
+
+def enable_incremental_vacuum():
+    """
+    Переводит существующую базу в auto_vacuum=INCREMENTAL. Нужен полный VACUUM:
+    база блокируется на всё время перестройки, запускать вне утренней рассылки.
+    """
+    conn = get_conn()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return auto_vacuum_mode() == AUTO_VACUUM_INCREMENTAL
+
+
 if __name__ == "__main__":
+    import sys
+
     init_db()
+    # python db.py migrate-payloads — перенести старые raw_json в сжатое хранилище
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-payloads":
+        print(f"Перенесено замеров: {migrate_raw_payloads()}")
@@ -9,6 +9,8 @@ CREATE TABLE IF NOT EXISTS users (
   tz_offset INTEGER,    -- смещение в секундах от UTC (опционально)
   notify_morning INTEGER DEFAULT 1,
   last_notify_date TEXT,
+  next_notify_utc TEXT, -- "YYYY-MM-DD HH:MM:SS" в UTC: когда отправить следующее утреннее уведомление
+  version INTEGER NOT NULL DEFAULT 0, -- растёт при каждом изменении строки (сверка кэша user_cache.py)
   created_at TEXT DEFAULT (datetime('now'))
 );
 
@@ -22,8 +24,90 @@ CREATE TABLE IF NOT EXISTS weather_samples (
   condition TEXT,       -- e.g. "Clear","Rain","Snow"
   precipitation_type TEXT, -- "rain","snow","none"
   pop REAL,             -- вероятность осадков
-  raw_json TEXT,
+  raw_json TEXT,         -- устарело: новые записи хранят ответ API в weather_payloads
+  payload_hash TEXT,     -- ссылка на weather_payloads.hash
   fetched_at TEXT DEFAULT (datetime('now'))
 );
 
 CREATE INDEX IF NOT EXISTS idx_weather_tg_date ON weather_samples(tg_id, date);
+CREATE INDEX IF NOT EXISTS idx_users_next_notify ON users(next_notify_utc);
+-- Выгрузка сводки по всем пользователям (export.py): диапазон дат и фильтр по городу
+CREATE INDEX IF NOT EXISTS idx_weather_date_condition ON weather_samples(date, condition);
+CREATE INDEX IF NOT EXISTS idx_users_city ON users(city);
+
+-- Локальный кэш геокодера: нормализованное название города -> координаты и таймзона
+CREATE TABLE IF NOT EXISTS geocode_cache (
+  query TEXT PRIMARY KEY,  -- название в нижнем регистре без лишних пробелов
+  name TEXT NOT NULL,      -- название, которое вернул геокодер
+  lat REAL NOT NULL,
+  lon REAL NOT NULL,
+  timezone TEXT,
+  updated_at TEXT DEFAULT (datetime('now'))
+);
+
+-- Дневная сводка для аналитики: одно состояние погоды на пользователя, город и день.
+-- Поддерживается при каждой записи в weather_samples (последний замер дня перезаписывает предыдущий).
+CREATE TABLE IF NOT EXISTS weather_daily (
+  tg_id INTEGER NOT NULL,
+  city TEXT NOT NULL,
+  date TEXT NOT NULL,      -- YYYY-MM-DD
+  condition TEXT NOT NULL,
+  PRIMARY KEY (tg_id, city, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_weather_daily_date ON weather_daily(date);
+
+-- Долгосрочная сводка по месяцам: сюда retention.py сворачивает замеры старше RETENTION_DAYS,
+-- после чего сырые строки weather_samples удаляются
+CREATE TABLE IF NOT EXISTS weather_monthly (
+  tg_id INTEGER NOT NULL,
+  city TEXT NOT NULL,      -- город пользователя на момент свёртки ('' если не выбран)
+  month TEXT NOT NULL,     -- YYYY-MM
+  condition TEXT NOT NULL,
+  samples INTEGER NOT NULL,
+  temp_sum REAL,           -- сумма temp: среднее = temp_sum / samples, суммы складываются при повторной свёртке
+  temp_min REAL,
+  temp_max REAL,
+  PRIMARY KEY (tg_id, city, month, condition)
+) WITHOUT ROWID;
+
+-- Ответы OpenWeatherMap: сжатый zlib JSON, один раз на локацию и момент запроса.
+-- hash — sha256 канонического JSON, поэтому один и тот же ответ у тысячи пользователей хранится один раз.
+CREATE TABLE IF NOT EXISTS weather_payloads (
+  hash TEXT PRIMARY KEY,
+  lat REAL,
+  lon REAL,
+  dt INTEGER,              -- время замера из ответа API (unix time)
+  data BLOB NOT NULL
+);
+-- Какие ответы ещё нужны замерам: по нему retention.py удаляет осиротевшие weather_payloads
+CREATE INDEX IF NOT EXISTS idx_weather_payload ON weather_samples(payload_hash) WHERE payload_hash IS NOT NULL;
+
+-- Состояние диалога (conversation.py): чего бот ждёт от пользователя, например названия города.
+-- Хранится в базе, поэтому переживает перезапуск и видно всем процессам с обработчиками.
+CREATE TABLE IF NOT EXISTS conversation_state (
+  tg_id INTEGER PRIMARY KEY,
+  state TEXT NOT NULL,
+  expires_at REAL NOT NULL   -- unix time
+);
+
+-- Аренда шардов рассылки воркерами (worker.py): шард = tg_id % число шардов.
+-- Упавший воркер перестаёт продлевать аренду, и после expires_at шард забирает другой.
+CREATE TABLE IF NOT EXISTS notify_leases (
+  shard INTEGER PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at REAL NOT NULL   -- unix time
+);
+
+-- Исходящие уведомления (outbox.py): строка живёт, пока сообщение не доставлено.
+-- owner/claimed_at — какой процесс их отправляет; строки упавшего процесса забирает другой.
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  chat_id INTEGER NOT NULL,
+  text TEXT NOT NULL,
+  kwargs TEXT,             -- JSON с дополнительными параметрами send_message
+  priority INTEGER NOT NULL DEFAULT 1,
+  owner TEXT,
+  claimed_at REAL NOT NULL, -- unix time последнего подтверждения владельцем
+  created_at TEXT DEFAULT (datetime('now'))
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_claimed ON outbox(claimed_at);
@@ -0,0 +1,97 @@
+# Выгрузка сводки погоды по всем пользователям и городам за произвольный период (для администраторов).
+# Данные идут потоком: db.iter_weather_aggregates отдаёт пачки строк, здесь они превращаются
+# в куски CSV или группы строк Parquet, так что память не зависит от размера периода.
+#
+#   python export.py 2025-01-01 2025-03-31 weather.csv
+#   python export.py 2025-01-01 2025-03-31 weather.parquet --city Москва
+import argparse
+import csv
+import io
+import os
+
+import db
+
+FORMATS = ("csv", "parquet")
+
+
+def iter_csv_chunks(date_from, date_to, city=None, batch_size=db.EXPORT_BATCH_SIZE):
+    """Генератор кусков CSV (str): заголовок, затем по куску на каждую пачку строк сводки."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(db.AGGREGATE_COLUMNS)
+    for rows in db.iter_weather_aggregates(date_from, date_to, city, batch_size):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def write_parquet(path, date_from, date_to, city=None, batch_size=db.EXPORT_BATCH_SIZE):
+    """Пишет сводку в Parquet: каждая пачка — отдельная группа строк. Нужен pyarrow."""
+    # pyarrow необязателен и тяжёлый, загружаем только для этого формата
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("date", pa.string()), ("city", pa.string()), ("condition", pa.string()),
+        ("samples", pa.int64()), ("users", pa.int64()),
+        ("temp_avg", pa.float64()), ("temp_min", pa.float64()), ("temp_max", pa.float64()),
+        ("pop_max", pa.float64()),
+    ])
+    written = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in db.iter_weather_aggregates(date_from, date_to, city, batch_size):
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            written += len(rows)
+    return written
+
+
+def write_csv(path, date_from, date_to, city=None, batch_size=db.EXPORT_BATCH_SIZE):
+    """Пишет сводку в CSV. Возвращает число строк данных."""
+    written = -1  # без заголовка
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for chunk in iter_csv_chunks(date_from, date_to, city, batch_size):
+            f.write(chunk)
+            written += chunk.count("\n")
+    return written
+
+
+def export(path, date_from, date_to, city=None, fmt=None):
+    """
+    Выгружает сводку в файл path. Формат — fmt или расширение файла ("csv"/"parquet").
+    Возвращает число строк. Parquet без установленного pyarrow — ValueError.
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower() or "csv"
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    if fmt == "parquet":
+        if not parquet_available():
+            raise ValueError("Для выгрузки в Parquet нужен pyarrow (pip install pyarrow)")
+        return write_parquet(path, date_from, date_to, city)
+    return write_csv(path, date_from, date_to, city)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузка сводки погоды по всем пользователям")
+    parser.add_argument("date_from", help="YYYY-MM-DD")
+    parser.add_argument("date_to", help="YYYY-MM-DD, включительно")
+    parser.add_argument("path", help="файл .csv или .parquet")
+    parser.add_argument("--city", help="только один город")
+    parser.add_argument("--format", choices=FORMATS, help="по умолчанию — по расширению файла")
+    args = parser.parse_args()
+
+    db.init_db()
+    count = export(args.path, args.date_from, args.date_to, args.city, args.format)
+    print(f"Выгружено строк: {count} -> {args.path}")
@@ -0,0 +1,174 @@
+# Режим прогноза (WEATHER_MODE=forecast): один запрос /data/2.5/forecast на локацию в день
+# и оценка правил (осадки, жара) по всем локациям и 3-часовым слотам одним векторным проходом NumPy.
+#
+#   weathers = day_weather([(forecast_json, tz, "2025-09-01"), ...])
+#   # -> словари того же вида, что weather.parse_weather, но по всему дню
+import datetime
+import json
+import os
+
+import pytz
+
+import notify_time
+from weather import get_forecast
+from weather_cache import WeatherCache
+
+FORECAST_MODE = os.getenv("WEATHER_MODE", "current") == "forecast"
+# Прогноз на 5 дней обновляется раз в 3 часа; для утреннего уведомления хватает одного запроса в день
+FORECAST_TTL = int(os.getenv("FORECAST_CACHE_TTL", str(6 * 3600)))
+
+# Правила дня: осадки в слоте с вероятностью не ниже POP_THRESHOLD, жара — максимум выше HEAT_THRESHOLD
+POP_THRESHOLD = float(os.getenv("FORECAST_POP_THRESHOLD", "0.4"))
+HEAT_THRESHOLD = 25
+# Какие часы местного времени считаются "днём" для предупреждения
+DAY_START_HOUR = 6
+DAY_END_HOUR = 22
+
+PRECIP_NONE = 0
+PRECIP_RAIN = 1
+PRECIP_SNOW = 2
+PRECIP_NAMES = ("none", "rain", "snow")
+
+# Прогнозы по ячейкам координат — тот же кэш, что для текущей погоды, но со своим TTL
+forecast_cache = WeatherCache(fetch=get_forecast, ttl=FORECAST_TTL)
+
+
+def _precip_code(condition):
+    """Так же, как weather.parse_weather: Rain/Drizzle — дождь, Snow — снег."""
+    condition = condition.lower()
+    if "rain" in condition or "drizzle" in condition:
+        return PRECIP_RAIN
+    if "snow" in condition:
+        return PRECIP_SNOW
+    return PRECIP_NONE
+
+
+class ForecastTable:
+    """Прогнозы нескольких локаций как матрицы (локация × слот). Недостающие слоты помечены в valid."""
+
+    __slots__ = ("dt", "temp", "temp_min", "temp_max", "pop", "precip", "valid", "conditions")
+
+    def __init__(self, forecasts):
+        import numpy as np  # NumPy нужен только в режиме прогноза, не при каждом импорте notifier
+
+        n = len(forecasts)
+        m = max((len(f.get("list") or []) for f in forecasts), default=0) or 1
+        self.dt = np.zeros((n, m), dtype=np.int64)
+        self.temp = np.full((n, m), np.nan)
+        self.temp_min = np.full((n, m), np.nan)
+        self.temp_max = np.full((n, m), np.nan)
+        self.pop = np.zeros((n, m))
+        self.precip = np.zeros((n, m), dtype=np.int8)
+        self.valid = np.zeros((n, m), dtype=bool)
+        self.conditions = np.full((n, m), "", dtype=object)
+
+        for i, forecast in enumerate(forecasts):
+            slots = forecast.get("list") or []
+            k = len(slots)
+            if not k:
+                continue
+            conditions = [slot["weather"][0]["main"] for slot in slots]
+            self.dt[i, :k] = [slot["dt"] for slot in slots]
+            self.temp[i, :k] = [slot["main"]["temp"] for slot in slots]
+            self.temp_min[i, :k] = [slot["main"]["temp_min"] for slot in slots]
+            self.temp_max[i, :k] = [slot["main"]["temp_max"] for slot in slots]
+            self.pop[i, :k] = [slot.get("pop", 0) for slot in slots]
+            self.precip[i, :k] = [_precip_code(c) for c in conditions]
+            self.conditions[i, :k] = conditions
+            self.valid[i, :k] = True
+
+
+def day_window(tz, local_date):
+    """Границы местного дня [DAY_START_HOUR, DAY_END_HOUR) в unix time."""
+    if isinstance(local_date, str):
+        local_date = datetime.date.fromisoformat(local_date)
+    bounds = []
+    for hour in (DAY_START_HOUR, DAY_END_HOUR):
+        local = tz.normalize(tz.localize(datetime.datetime.combine(local_date, datetime.time(hour))))
+        bounds.append(int(local.timestamp()))
+    return bounds
+
+
+def evaluate(table, rows, starts, ends):
+    """
+    Правила для n запросов разом: rows — строка таблицы (локация) каждого запроса,
+    starts/ends — границы его дня (unix time). Одна локация может встречаться с разными днями.
+    Возвращает словарь массивов длины n: has_data, rain, snow, heat, temp_min, temp_max, pop, first (индекс первого слота дня).
+    """
+    import numpy as np
+
+    rows = np.asarray(rows, dtype=np.intp)
+    starts = np.asarray(starts, dtype=np.int64)[:, None]
+    ends = np.asarray(ends, dtype=np.int64)[:, None]
+    dt = table.dt[rows]
+    in_day = table.valid[rows] & (dt >= starts) & (dt < ends)
+    likely = in_day & (table.pop[rows] >= POP_THRESHOLD)
+    precip = table.precip[rows]
+    temp_max = np.where(in_day, table.temp_max[rows], -np.inf).max(axis=1)
+    return {
+        "has_data": in_day.any(axis=1),
+        "rain": (likely & (precip == PRECIP_RAIN)).any(axis=1),
+        "snow": (likely & (precip == PRECIP_SNOW)).any(axis=1),
+        "heat": temp_max > HEAT_THRESHOLD,
+        "temp_min": np.where(in_day, table.temp_min[rows], np.inf).min(axis=1),
+        "temp_max": temp_max,
+        "pop": np.where(in_day, table.pop[rows], 0.0).max(axis=1),
+        "first": in_day.argmax(axis=1),
+    }
+
+
+def day_weather(items):
+    """
+    items — тройки (ответ /forecast, таймзона, местная дата). Для каждой возвращает словарь погоды на день
+    (ключи как у weather.parse_weather) или None, если прогноз не покрывает этот день.
+    """
+    if not items:
+        return []
+    # Каждый прогноз разбирается в таблицу один раз, сколько бы дней и таймзон к нему ни относилось
+    index = {}
+    forecasts = []
+    rows = []
+    for forecast, _, _ in items:
+        row = index.get(id(forecast))
+        if row is None:
+            row = index[id(forecast)] = len(forecasts)
+            forecasts.append(forecast)
+        rows.append(row)
+    table = ForecastTable(forecasts)
+    windows = [day_window(tz, local_date) for _, tz, local_date in items]
+    result = evaluate(table, rows, [w[0] for w in windows], [w[1] for w in windows])
+
+    raws = {}  # JSON прогноза для замера: тоже один раз на локацию
+    weathers = []
+    for i, row in enumerate(rows):
+        if not result["has_data"][i]:
+            weathers.append(None)
+            continue
+        # Снег важнее дождя: о нём предупреждаем, даже если днём ожидается и то и другое
+        precip = PRECIP_SNOW if result["snow"][i] else PRECIP_RAIN if result["rain"][i] else PRECIP_NONE
+        first = result["first"][i]
+        raw = raws.get(row)
+        if raw is None:
+            raw = raws[row] = json.dumps(forecasts[row], ensure_ascii=False)
+        weather = {
+            "temp": float(table.temp[row, first]),
+            "temp_min": float(result["temp_min"][i]),
+            "temp_max": float(result["temp_max"][i]),
+            "condition": "Snow" if precip == PRECIP_SNOW else "Rain" if precip == PRECIP_RAIN
+                         else table.conditions[row, first],
+            "precipitation_type": PRECIP_NAMES[precip],
+            "pop": round(float(result["pop"][i]), 2),
+            "raw_json": raw,
+        }
+        # Прогноз из кэша, пока API недоступен (weather_cache.WeatherCache._stale)
+        if forecasts[row].get("stale"):
+            weather.update(stale=True, stale_age=forecasts[row]["stale_age"])
+        weathers.append(weather)
+    return weathers
+
+
+def today_weather(lat, lon, timezone_str=None, tz_offset=None):
+    """Погода на сегодняшний местный день для одной точки (например, сразу после выбора города)."""
+    tz = notify_time.user_tz(timezone_str, tz_offset) or pytz.utc
+    local_date = datetime.datetime.now(tz).date()
+    return day_weather([(forecast_cache.get(lat, lon), tz, local_date)])[0]
@@ -0,0 +1,182 @@
+import asyncio
+import csv
+import os
+import datetime
+import threading
+from collections import OrderedDict
+import requests
+import pytz
+from dotenv import load_dotenv
+
+import db
+from circuit import CircuitBreaker
+
+load_dotenv()
+WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+GEO_URL = os.getenv("OWM_BASE_URL", "http://api.openweathermap.org") + "/geo/1.0/direct"
+REQUEST_TIMEOUT = 10
+
+# Сколько городов держим в памяти процесса перед таблицей geocode_cache
+MEMO_MAX_SIZE = 10000
+
+# Если геокодер не отвечает, новые названия сразу получают CircuitOpenError;
+# города из geocode_cache продолжают работать без сети
+geocode_breaker = CircuitBreaker("geocoder")
+
+_tf = None
+_tf_lock = threading.Lock()
+_memo = OrderedDict()  # нормализованное название -> {'name', 'lat', 'lon', 'timezone'}
+# Обработчики и вытеснение работают из разных потоков: _memo меняется только под этой блокировкой
+_memo_lock = threading.Lock()
+
+
+def get_timezone_finder():
+    """Один TimezoneFinder на процесс: загрузка полигонов таймзон дорогая, делаем её один раз и лениво."""
+    global _tf
+    if _tf is None:
+        with _tf_lock:
+            if _tf is None:
+                from timezonefinder import TimezoneFinder
+                _tf = TimezoneFinder()
+    return _tf
+
+
+def normalize_city(city_name):
+    """Ключ кэша: нижний регистр, без лишних пробелов."""
+    return " ".join(city_name.split()).casefold()
+
+
+def _request_geocode(city_name):
+    params = {"q": city_name, "limit": 1, "appid": WEATHER_API_KEY}
+    r = requests.get(GEO_URL, params=params, timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
+
+def geocode(city_name):
+    """Ищет город через геокодер OpenWeatherMap. Возвращает {'name', 'lat', 'lon'} или None."""
+    return _first_city(geocode_breaker.call(_request_geocode, city_name))
+
+
+async def geocode_async(session, city_name):
+    """То же, что geocode, но через общую aiohttp-сессию."""
+    params = {"q": city_name, "limit": 1, "appid": WEATHER_API_KEY}
+    geocode_breaker.before_call()
+    try:
+        async with session.get(GEO_URL, params=params) as r:
+            r.raise_for_status()
+            data = await r.json()
+    except Exception as e:
+        geocode_breaker.record_failure(e, _request_geocode, city_name)
+        raise
+    geocode_breaker.record_success()
+    return _first_city(data)
+
+
+def _first_city(data):
+    if not data:
+        return None
+    city_info = data[0]
+    return {"name": city_info["name"], "lat": city_info["lat"], "lon": city_info["lon"]}
+
+
+def utc_offset_hours(timezone_str):
+    """Текущее смещение таймзоны от UTC в часах (None, если таймзона неизвестна)."""
+    if not timezone_str:
+        return None
+    tz = pytz.timezone(timezone_str)
+    return int(tz.utcoffset(datetime.datetime.utcnow()).total_seconds() / 3600)
+
+
+def resolve_timezone(lat, lon):
+    """Определяет таймзону по координатам. Возвращает (timezone_str, смещение UTC в часах)."""
+    timezone_str = get_timezone_finder().timezone_at(lat=lat, lng=lon)
+    return timezone_str, utc_offset_hours(timezone_str)
+
+
+# -------------------- Кэш геокодера --------------------
+def _remember(query, city):
+    with _memo_lock:
+        _memo[query] = city
+        _memo.move_to_end(query)
+        while len(_memo) > MEMO_MAX_SIZE:
+            _memo.popitem(last=False)
+
+
+def lookup_cached(city_name):
+    """Город из памяти процесса или таблицы geocode_cache, без обращения к сети."""
+    query = normalize_city(city_name)
+    with _memo_lock:
+        city = _memo.get(query)
+        if city is not None:
+            # LRU: часто запрашиваемые города не вытесняются первыми
+            _memo.move_to_end(query)
+    if city is None:
+        city = db.get_geocode(query)
+        if city is not None:
+            _remember(query, city)
+    return city
+
+
+def _store(city_name, found):
+    """Дополняет ответ геокодера таймзоной и сохраняет его под запросом пользователя и под каноническим именем."""
+    timezone_str, _ = resolve_timezone(found["lat"], found["lon"])
+    city = {"name": found["name"], "lat": found["lat"], "lon": found["lon"], "timezone": timezone_str}
+    queries = {normalize_city(city_name), normalize_city(found["name"])}
+    db.save_geocodes([(q, city["name"], city["lat"], city["lon"], timezone_str) for q in queries])
+    for q in queries:
+        _remember(q, city)
+    return city
+
+
+def _with_offset(city):
+    return dict(city, tz_offset=utc_offset_hours(city["timezone"]))
+
+
+def resolve_city(city_name):
+    """
+    Город по названию: {'name', 'lat', 'lon', 'timezone', 'tz_offset'} или None.
+    Сначала смотрим локальный кэш, в геокодер идём только для новых названий.
+    """
+    city = lookup_cached(city_name)
+    if city is None:
+        found = geocode(city_name)
+        if not found:
+            return None
+        city = _store(city_name, found)
+    return _with_offset(city)
+
+
+async def resolve_city_async(session, city_name):
+    """Асинхронный вариант resolve_city: сеть через aiohttp, SQLite и таймзона — в отдельном потоке."""
+    city = await asyncio.to_thread(lookup_cached, city_name)
+    if city is None:
+        found = await geocode_async(session, city_name)
+        if not found:
+            return None
+        city = await asyncio.to_thread(_store, city_name, found)
+    return _with_offset(city)
+
+
+def preload_geocode_csv(path):
+    """
+    Загружает частые города из CSV с колонками city,lat,lon[,name][,timezone].
+    Пустую таймзону вычисляет по координатам. Возвращает число загруженных строк.
+    """
+    rows = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for rec in csv.DictReader(f):
+            lat, lon = float(rec["lat"]), float(rec["lon"])
+            name = rec.get("name") or rec["city"]
+            timezone_str = rec.get("timezone") or resolve_timezone(lat, lon)[0]
+            rows.append((normalize_city(rec["city"]), name, lat, lon, timezone_str))
+    db.save_geocodes(rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python geo.py cities.csv
+    db.init_db()
+    print(f"Загружено городов: {preload_geocode_csv(sys.argv[1])}")
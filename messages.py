@@ -0,0 +1,89 @@
+# Тексты и клавиатуры, общие для синхронного (bot.py) и асинхронного (bot_async.py) режимов
+from telebot import types
+
+BTN_CITY = "Выбрать город"
+BTN_WEATHER_TODAY = "Какая сегодня погода?"
+BTN_ANALYTICS = "Моя аналитика"
+
+GREETING = "Привет! Я бот-погодник 🌤\nВыбери действие ниже или напиши город вручную:"
+HELP = ("Команды:\n"
+        "/start - начать работу с ботом\n"
+        "/help - помощь\n"
+        "/setcity - изменить город")
+ASK_CITY = "Напиши название города (например, Moscow):"
+CITY_NOT_FOUND = "Город не найден 😢 Попробуй ещё раз."
+NEED_CITY = "Сначала выбери город через кнопку 'Выбрать город'."
+NEED_CITY_ANALYTICS = "Сначала выберите город через кнопку 'Выбрать город'."
+UNKNOWN_TEXT = "Не понял 🤔 Выбери действие на клавиатуре ниже. Сменить город — кнопка 'Выбрать город'."
+GEOCODER_UNAVAILABLE = "Поиск городов сейчас недоступен 😢 Попробуй через пару минут."
+CHOOSE_PERIOD = "Выберите период для аналитики или экспортируйте данные:"
+
+# Периоды аналитики: ключ из callback_data -> (период для db.get_weather_counts, подпись)
+ANALYTICS_PERIODS = {
+    "week": ("-7 days", "7 дней"),
+    "month": ("-1 month", "30 дней"),
+    "quarter": ("-3 months", "90 дней"),
+}
+DEFAULT_PERIOD = ANALYTICS_PERIODS["month"]
+
+
+def main_keyboard():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(types.KeyboardButton(BTN_CITY),
+               types.KeyboardButton(BTN_WEATHER_TODAY),
+               types.KeyboardButton(BTN_ANALYTICS))
+    return markup
+
+
+def analytics_keyboard():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    # Периоды аналитики
+    markup.add(
+        types.InlineKeyboardButton("Неделя", callback_data="analytics_week"),
+        types.InlineKeyboardButton("Месяц", callback_data="analytics_month"),
+        types.InlineKeyboardButton("Квартал", callback_data="analytics_quarter")
+    )
+    # Кнопка экспорта
+    markup.add(
+        types.InlineKeyboardButton("Экспорт в Google Sheets", callback_data="export_sheets")
+    )
+    return markup
+
+
+def city_saved(city_name, timezone_str, tz_offset):
+    offset = f"UTC{tz_offset:+d}" if tz_offset is not None else "UTC?"
+    return f"Город успешно сохранён: {city_name} ✅\nТаймзона: {timezone_str}, {offset}"
+
+
+def city_alert(city_name, w):
+    """Предупреждение сразу после выбора города или None."""
+    if w['precipitation_type'] in ["rain", "snow"]:
+        return f"Прогноз на сегодня в {city_name}: {w['condition']} 🌧❄️"
+    if w['temp_max'] >= 25:
+        return f"Сегодня в {city_name} жарко 🔥 {w['temp_max']}°C"
+    return None
+
+
+def stale_note(weather):
+    """Пометка для ответа из кэша, когда сервис погоды не отвечает (weather_cache: stale, stale_age)."""
+    if not weather.get("stale"):
+        return ""
+    return f"⚠️ Данные {weather['stale_age'] // 60} мин. назад: сервис погоды сейчас недоступен"
+
+
+def weather_today(city_name, weather):
+    text = (f"Погода сегодня в {city_name}:\n"
+            f"{weather['condition']} 🌤\n"
+            f"Температура: {weather['temp']}°C "
+            f"(min {weather['temp_min']}°C, max {weather['temp_max']}°C)")
+    note = stale_note(weather)
+    return f"{text}\n{note}" if note else text
+
+
+def analytics_text(city_name, period_name, data):
+    total = sum(count for _, count in data)
+    text = f"📊 Аналитика погоды для *{city_name}* за {period_name}:\n\n"
+    for condition, count in data:
+        percent = round(count / total * 100, 1)
+        text += f"- {condition}: {count} дней ({percent}%)\n"
+    return text
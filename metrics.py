@@ -0,0 +1,232 @@
+# Лёгкие метрики горячих путей: таймеры и счётчики в памяти, гистограммы, вывод в формате Prometheus.
+# Включаются переменной METRICS_ENABLED=1; выключенные декораторы сводятся к одной проверке флага.
+#
+#   @metrics.timed("weather_fetch")
+#   def get_weather(...): ...
+#
+#   with metrics.timer("send_message"):
+#       bot.send_message(...)
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+PREFIX = "weather_bot"
+
+# Границы корзин гистограммы, секунды
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Накопительная гистограмма длительностей с суммой и счётчиком (как у Prometheus)."""
+
+    __slots__ = ("counts", "total", "count", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """Приближённый квантиль по границам корзин."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+_lock = threading.Lock()
+_histograms = {}  # имя -> Histogram
+_counters = {}    # имя -> int
+_gauges = {}      # имя -> функция без аргументов, возвращающая текущее значение
+
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = flag
+
+
+def observe(name, seconds, error=False):
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.observe(seconds, error)
+
+
+def inc(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+@contextmanager
+def timer(name):
+    """Замеряет блок кода. Ошибка внутри блока тоже учитывается (и пробрасывается дальше)."""
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(name, time.perf_counter() - started, error)
+
+
+def timed(name):
+    """Декоратор-таймер для функции или корутины (обработчики bot_async.py)."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not ENABLED:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                error = False
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    observe(name, time.perf_counter() - started, error)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            error = False
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                observe(name, time.perf_counter() - started, error)
+        return wrapper
+    return decorator
+
+
+def register_gauge(name, func):
+    """Текущее значение (глубина очереди, размер кэша) считывается func() в момент запроса метрик."""
+    _gauges[name] = func
+
+
+def _read_gauges():
+    values = {}
+    for name, func in list(_gauges.items()):
+        try:
+            values[name] = func()
+        except Exception:
+            continue
+    return values
+
+
+def snapshot():
+    """Копия текущих значений: {'histograms': {имя: {...}}, 'counters': {...}}."""
+    with _lock:
+        hists = {name: {"count": h.count, "sum": h.total, "errors": h.errors,
+                        "buckets": list(h.counts), "p50": h.quantile(0.5), "p95": h.quantile(0.95),
+                        "p99": h.quantile(0.99)}
+                 for name, h in _histograms.items()}
+        return {"histograms": hists, "counters": dict(_counters)}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def render_prometheus():
+    """Текстовый формат экспозиции Prometheus."""
+    snap = snapshot()
+    lines = []
+    if snap["histograms"]:
+        lines.append(f"# TYPE {PREFIX}_duration_seconds histogram")
+    for name, h in sorted(snap["histograms"].items()):
+        cumulative = 0
+        for bound, c in zip(BUCKETS, h["buckets"]):
+            cumulative += c
+            lines.append(f'{PREFIX}_duration_seconds_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}_duration_seconds_bucket{{op="{name}",le="+Inf"}} {h["count"]}')
+        lines.append(f'{PREFIX}_duration_seconds_sum{{op="{name}"}} {h["sum"]:.6f}')
+        lines.append(f'{PREFIX}_duration_seconds_count{{op="{name}"}} {h["count"]}')
+    if snap["histograms"]:
+        lines.append(f"# TYPE {PREFIX}_errors_total counter")
+        for name, h in sorted(snap["histograms"].items()):
+            lines.append(f'{PREFIX}_errors_total{{op="{name}"}} {h["errors"]}')
+    for name, value in sorted(snap["counters"].items()):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total {value}")
+    for name, value in sorted(_read_gauges().items()):
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        lines.append(f"{PREFIX}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def render_text():
+    """Короткая сводка для команды /stats."""
+    snap = snapshot()
+    if not ENABLED:
+        return "Метрики выключены (METRICS_ENABLED=1)"
+    lines = []
+    for name, h in sorted(snap["histograms"].items()):
+        avg = h["sum"] / h["count"] * 1000 if h["count"] else 0
+        lines.append(f"{name}: {h['count']} выз., ср. {avg:.1f} мс, p95 ≤ {h['p95'] * 1000:g} мс, ошибок {h['errors']}")
+    for name, value in sorted(snap["counters"].items()):
+        lines.append(f"{name}: {value}")
+    for name, value in sorted(_read_gauges().items()):
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines)
+
+
+def serve(port=METRICS_PORT):
+    """Поднимает HTTP /metrics в фоновом потоке (для режима polling, где нет своего HTTP-сервера)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
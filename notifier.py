@@ -0,0 +1,271 @@
+import datetime
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import db
+import forecast
+import messages
+import notify_time
+from outbox import BULK, Outbox
+from ratelimit import GLOBAL_RATE
+from weather_cache import cell_key, weather_cache
+
+# Сколько локаций запрашиваем одновременно и сколько потоков отправляют сообщения
+FETCH_WORKERS = 8
+SEND_WORKERS = 8
+# Сколько пользователей забираем за один тик планировщика
+DUE_BATCH_LIMIT = 10000
+# Если уведомление просрочено сильнее (бот был выключен), не шлём устаревшее "утреннее" сообщение
+LATE_TOLERANCE = datetime.timedelta(hours=1)
+# За сколько минут до уведомления погода для его локации загружается в кэш
+PREFETCH_LEAD = datetime.timedelta(minutes=int(os.getenv("PREFETCH_LEAD_MINUTES", "15")))
+# Запускать ли рассылку внутри процесса бота (bot.py, bot_async.py, webhook.py). Такой проход не берёт аренду
+# шардов, поэтому вместе с воркерами (worker.py) он выбрал бы тех же пользователей: при воркерах — RUN_SCHEDULER=0
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "1") == "1"
+
+
+def build_morning_message(city, weather):
+    """Текст утреннего уведомления или None, если предупреждать не о чем."""
+    notify = False
+    message = f"Погода в {city} сегодня:\n"
+
+    if weather["precipitation_type"] in ["rain", "snow"]:
+        notify = True
+        message += f"❗ Ожидаются осадки: {weather['precipitation_type']}\n"
+
+    if weather["temp_max"] > 25:
+        notify = True
+        message += f"🔥 Жара: до {weather['temp_max']}°C\n"
+
+    if weather.get("stale"):
+        message += messages.stale_note(weather) + "\n"
+
+    return message if notify else None
+
+
+def group_by_location(users):
+    """Группирует пользователей по ячейке координат, чтобы каждая локация запрашивалась один раз."""
+    groups = {}
+    for user in users:
+        groups.setdefault(cell_key(user["lat"], user["lon"]), []).append(user)
+    return groups
+
+
+def _enqueue_group(outbox, users, weather):
+    """
+    Ставит уведомления одной локации в outbox (одной транзакцией) и переносит пользователям
+    следующее уведомление. Возвращает пары (future, пользователь) и число пропущенных.
+    """
+    texts = [(user, build_morning_message(user["city"], weather)) for user in users]
+    to_send = [(user, text) for user, text in texts if text]
+    # Уведомление переносится на следующее утро в той же транзакции, что и запись сообщений в outbox:
+    # другой воркер, забравший шард, уже не выберет этих пользователей
+    advance = [(user["next_notify"], user["local_date"], user["tg_id"]) for user in users]
+    if to_send:
+        futures = outbox.send_many([(user["chat_id"], text) for user, text in to_send], BULK, advance=advance)
+    else:
+        futures = []
+        db.advance_next_notify(advance)
+
+    # Устаревший ответ (API недоступно) уже записан, когда был получен: второй раз его не сохраняем
+    samples = [] if weather.get("stale") else to_send
+    for user, _ in samples:
+        # Сохраняем прогноз в БД (важно для аналитики)
+        db.queue_weather_sample(
+            user["tg_id"],
+            user["local_date"],
+            weather["temp"],
+            weather["temp_max"],
+            weather["temp_min"],
+            weather["condition"],
+            weather["precipitation_type"],
+            weather["pop"],
+            weather["raw_json"]
+        )
+    return list(zip(futures, (user for user, _ in to_send))), len(users) - len(to_send)
+
+
+def _prepare_due(users, now_utc):
+    """
+    Для каждого пользователя вычисляет местную дату уведомления и следующий момент в UTC.
+    Возвращает (пользователи к отправке, число просроченных, которые только перенесены).
+    """
+    ready = []
+    late = 0
+    for user in users:
+        tz = notify_time.user_tz(user["timezone"], user["tz_offset"])
+        if tz is None:
+            continue
+        due = notify_time.parse_utc(user["next_notify_utc"])
+        user["local_date"] = due.astimezone(tz).date().isoformat()
+        user["next_notify"] = notify_time.next_notify_at(tz, now_utc)[0].strftime(notify_time.UTC_FORMAT)
+        if now_utc - due > LATE_TOLERANCE:
+            late += 1
+            db.queue_advance_next_notify(user["tg_id"], user["next_notify"], user["last_notify_date"])
+            continue
+        ready.append(user)
+    return ready, late
+
+
+def _lease_lost(keep_lease, stats):
+    """Проверяет (и продлевает) аренду шарда. True — шард забрал другой воркер, проход надо остановить."""
+    if keep_lease is None or keep_lease():
+        return False
+    stats["lease_lost"] = True
+    return True
+
+
+def _fetch_groups(cache, groups, fetch_workers, stats, keep_lease=None):
+    """
+    Параллельно запрашивает данные для каждой локации. Выдаёт (ключ локации, данные) по мере готовности.
+    После каждого ответа продлевает аренду шарда (keep_lease); если она потеряна — прекращает запросы.
+    """
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool:
+        fetches = {fetch_pool.submit(cache.get, key[0], key[1]): key for key in groups}
+        for future in as_completed(fetches):
+            if _lease_lost(keep_lease, stats):
+                fetch_pool.shutdown(wait=False, cancel_futures=True)
+                return
+            key = fetches[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                stats["fetch_errors"] += 1
+                stats["failed"] += len(groups[key])
+                print(f"Ошибка при получении погоды для {key}: {e}")
+                continue
+            yield key, data
+
+
+def _current_pass(outbox, groups, fetch_workers, stats, deliveries, keep_lease=None):
+    """Текущая погода: каждая локация ставится в очередь, как только пришёл её ответ."""
+    for key, weather in _fetch_groups(weather_cache, groups, fetch_workers, stats, keep_lease):
+        queued, skipped = _enqueue_group(outbox, groups[key], weather)
+        deliveries.extend(queued)
+        stats["skipped"] += skipped
+        stats["advanced"] += len(groups[key])
+
+
+def _forecast_pass(outbox, groups, fetch_workers, stats, deliveries, keep_lease=None):
+    """
+    Прогноз на день: сначала прогнозы всех локаций, затем одна векторная оценка правил (forecast.day_weather)
+    по всем локациям и дням пользователей сразу.
+    """
+    forecasts = dict(_fetch_groups(forecast.forecast_cache, groups, fetch_workers, stats, keep_lease))
+    if stats.get("lease_lost"):
+        return
+    # В одной ячейке могут оказаться пользователи с разными таймзонами или местными датами
+    days = {}
+    for key, data in forecasts.items():
+        for user in groups[key]:
+            days.setdefault((key, user["timezone"], user["tz_offset"], user["local_date"]), []).append(user)
+    keys = list(days)
+    weathers = forecast.day_weather([(forecasts[key], notify_time.user_tz(timezone, tz_offset), local_date)
+                                     for key, timezone, tz_offset, local_date in keys])
+    for day, weather in zip(keys, weathers):
+        if _lease_lost(keep_lease, stats):
+            return
+        users = days[day]
+        if weather is None:
+            # Прогноз не покрывает день — предупреждать не о чем, только переносим уведомление
+            stats["skipped"] += len(users)
+            db.advance_next_notify([(user["next_notify"], user["local_date"], user["tg_id"]) for user in users])
+            stats["advanced"] += len(users)
+            continue
+        queued, skipped = _enqueue_group(outbox, users, weather)
+        deliveries.extend(queued)
+        stats["skipped"] += skipped
+        stats["advanced"] += len(users)
+
+
+def prefetch_upcoming(now_utc=None, lead=PREFETCH_LEAD, fetch_workers=FETCH_WORKERS, shard=None, shards=None):
+    """
+    Загружает в кэш погоду для локаций пользователей, у которых уведомление наступит в ближайшие lead.
+    Вызывается на каждом тике: в окно попадают только новые пользователи, а уже загруженные ячейки
+    не запрашиваются повторно, поэтому запросы к API растянуты по времени, а не собраны в момент рассылки.
+    Возвращает статистику: локаций в окне, запрошено, ошибок.
+    """
+    started = time.monotonic()
+    now_utc = now_utc or datetime.datetime.now(datetime.timezone.utc)
+    rows = db.get_upcoming_locations(now_utc.strftime(notify_time.UTC_FORMAT),
+                                     (now_utc + lead).strftime(notify_time.UTC_FORMAT), shard, shards)
+    cells = {cell_key(lat, lon) for lat, lon in rows}
+    stats = {"locations": len(cells), "fetched": 0, "errors": 0}
+    cache = forecast.forecast_cache if forecast.FORECAST_MODE else weather_cache
+
+    if cells:
+        with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+            futures = {pool.submit(cache.warm, lat, lon, lead.total_seconds()): (lat, lon)
+                       for lat, lon in cells}
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        stats["fetched"] += 1
+                except Exception as e:
+                    # Не страшно: при рассылке ячейка будет запрошена обычным путём
+                    stats["errors"] += 1
+                    print(f"Ошибка предзагрузки погоды для {futures[future]}: {e}")
+
+    stats["wall_time"] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def run_morning_notifications(bot, now_utc=None, fetch_workers=FETCH_WORKERS, send_workers=SEND_WORKERS,
+                              shard=None, shards=None, global_rate=GLOBAL_RATE, outbox=None, keep_lease=None):
+    """
+    Один проход утренней рассылки: забирает пользователей, чьё next_notify_utc уже наступило,
+    запрашивает погоду по каждой локации один раз и ставит сообщения в outbox (лимиты Telegram и повторы — там).
+    outbox — общая очередь бота; если не передана, на проход создаётся своя (global_rate, send_workers потоков).
+    shard/shards — обработать только свой шард (см. worker.py); global_rate — доля общего лимита Telegram.
+    keep_lease() — продлевает аренду шарда и возвращает False, если она потеряна: тогда проход
+    останавливается, не поставив в очередь оставшиеся локации (stats["lease_lost"]).
+    stats["advanced"] — сколько пользователей перенесено на следующее утро (с сообщением, без него или
+    как просроченные); пользователи локаций, погоду для которых получить не удалось, останутся должниками.
+    Дожидается доставки и возвращает словарь со статистикой прохода.
+    """
+    started = time.monotonic()
+    now_utc = now_utc or datetime.datetime.now(datetime.timezone.utc)
+    if now_utc.tzinfo is None:
+        now_utc = now_utc.replace(tzinfo=datetime.timezone.utc)
+    due = db.get_due_users(now_utc.strftime(notify_time.UTC_FORMAT), DUE_BATCH_LIMIT, shard, shards)
+    users, late = _prepare_due(due, now_utc)
+    groups = group_by_location(users)
+
+    stats = {"users": len(users), "locations": len(groups), "sent": 0, "skipped": 0,
+             "failed": 0, "fetch_errors": 0, "late": late, "advanced": late, "lease_lost": False}
+    if not users:
+        db.flush_writes()
+        stats["wall_time"] = round(time.monotonic() - started, 3)
+        stats["throughput"] = 0.0
+        return stats
+
+    own_outbox = outbox is None
+    if own_outbox:
+        outbox = Outbox(bot, global_rate=global_rate, workers=send_workers).start(recover=False)
+
+    deliveries = []
+    try:
+        if forecast.FORECAST_MODE:
+            _forecast_pass(outbox, groups, fetch_workers, stats, deliveries, keep_lease)
+        else:
+            _current_pass(outbox, groups, fetch_workers, stats, deliveries, keep_lease)
+        wait([future for future, _ in deliveries])
+    finally:
+        if own_outbox:
+            outbox.stop()
+
+    for future, user in deliveries:
+        if future.exception() is None:
+            stats["sent"] += 1
+        else:
+            stats["failed"] += 1
+            print(f"Ошибка при отправке уведомления пользователю {user['tg_id']}: {future.exception()}")
+
+    # Все замеры, даты уведомлений и отметки о доставке пишутся пачками; дожидаемся их до следующего тика
+    db.flush_writes()
+
+    wall_time = time.monotonic() - started
+    stats["wall_time"] = round(wall_time, 3)
+    stats["throughput"] = round(stats["sent"] / wall_time, 1) if wall_time else 0.0
+    return stats
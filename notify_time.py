@@ -0,0 +1,50 @@
+# Расчёт момента следующего утреннего уведомления в UTC с учётом IANA-таймзоны (DST, получасовые зоны)
+import datetime
+import pytz
+
+NOTIFY_HOUR = 8
+NOTIFY_MINUTE = 0
+
+UTC_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def user_tz(timezone_str=None, tz_offset=None):
+    """Таймзона пользователя: IANA-имя, а для старых записей без него — фиксированное смещение."""
+    if timezone_str:
+        return pytz.timezone(timezone_str)
+    if tz_offset is not None:
+        # В старых записях смещение хранилось в секундах, в новых — в часах
+        minutes = tz_offset * 60 if abs(tz_offset) <= 14 else tz_offset // 60
+        return pytz.FixedOffset(minutes)
+    return None
+
+
+def next_notify_at(tz, after_utc):
+    """
+    Ближайший момент NOTIFY_HOUR:NOTIFY_MINUTE по местному времени строго после after_utc.
+    Возвращает (момент в UTC как aware datetime, местная дата этого уведомления).
+    """
+    if after_utc.tzinfo is None:
+        after_utc = pytz.utc.localize(after_utc)
+    local_day = after_utc.astimezone(tz).date()
+    while True:
+        local_naive = datetime.datetime.combine(local_day, datetime.time(NOTIFY_HOUR, NOTIFY_MINUTE))
+        # normalize сдвигает время, попавшее в "дыру" перехода на летнее время
+        moment = tz.normalize(tz.localize(local_naive)).astimezone(pytz.utc)
+        if moment > after_utc:
+            return moment, local_day
+        local_day += datetime.timedelta(days=1)
+
+
+def next_notify_utc(timezone_str=None, tz_offset=None, after_utc=None):
+    """Строка 'YYYY-MM-DD HH:MM:SS' (UTC) следующего уведомления или None, если таймзона неизвестна."""
+    tz = user_tz(timezone_str, tz_offset)
+    if tz is None:
+        return None
+    moment, _ = next_notify_at(tz, after_utc or datetime.datetime.now(pytz.utc))
+    return moment.strftime(UTC_FORMAT)
+
+
+def parse_utc(value):
+    """Строка из колонки next_notify_utc -> aware datetime."""
+    return pytz.utc.localize(datetime.datetime.strptime(value, UTC_FORMAT))
@@ -0,0 +1,306 @@
+# Единая очередь исходящих сообщений Telegram.
+# Общий лимит и интервал в один чат, повтор после 429 через retry_after, ответы пользователям
+# раньше массовой рассылки. Уведомления рассылки (persist=True) лежат в таблице outbox до доставки,
+# поэтому перезапуск бота их не теряет.
+#
+#   outbox = Outbox(bot).start()
+#   outbox.send_message(chat_id, "Привет")                       # ответ пользователю
+#   futures = outbox.send_many([(chat_id, text), ...])           # рассылка, с сохранением в БД
+import heapq
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+import db
+import metrics
+from ratelimit import GLOBAL_RATE, PER_CHAT_INTERVAL, TokenBucket
+
+# Приоритеты: меньше — раньше
+INTERACTIVE = 0
+BULK = 1
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+# Сколько раз повторять при сетевых ошибках и 5xx (429 не считается — там Telegram сам говорит, когда можно)
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+# Как часто владелец подтверждает свои строки в outbox и через сколько чужие строки считаются брошенными
+HEARTBEAT_INTERVAL = float(os.getenv("OUTBOX_HEARTBEAT", "30"))
+STALE_AFTER = float(os.getenv("OUTBOX_STALE_AFTER", "120"))
+# Окно для расчёта скорости отправки
+RATE_WINDOW = 60.0
+
+
+class _Item:
+    __slots__ = ("method", "chat_id", "args", "kwargs", "priority", "future", "row_id", "attempts", "seq")
+
+    def __init__(self, method, chat_id, args, kwargs, priority, row_id=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.row_id = row_id
+        self.attempts = 0
+        self.seq = 0
+
+
+class Outbox:
+    """
+    Диспетчер исходящих сообщений. Один поток выбирает следующее сообщение (по приоритету,
+    с учётом занятости чата и общего ведра токенов), отправка идёт в пуле workers потоков.
+    Сообщения в один чат не отправляются параллельно и не чаще per_chat_interval.
+    """
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL,
+                 workers=OUTBOX_WORKERS, owner=None):
+        self.bot = bot
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+
+        self._ready = []         # куча (priority, seq, item)
+        self._delayed = []       # куча (not_before, seq, item): ждут retry_after или свободного чата
+        self._chat_free_at = {}  # chat_id -> monotonic-время, с которого в чат можно писать
+        self._busy_chats = {}    # chat_id -> сообщения, ждущие окончания отправки в этот чат
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopped = False
+        self._in_flight = 0
+
+        self._sent_times = deque()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+
+    # -------------------- Постановка в очередь --------------------
+    def send_message(self, chat_id, text, priority=INTERACTIVE, persist=False, **kwargs):
+        """Ставит send_message в очередь. Возвращает Future с результатом отправки."""
+        if persist:
+            return self.send_many([(chat_id, text)], priority, **kwargs)[0]
+        return self._put(_Item("send_message", chat_id, (text,), kwargs, priority))
+
+    def send_photo(self, chat_id, photo, priority=INTERACTIVE, **kwargs):
+        """Фото не сохраняются в БД: это ответы на запрос пользователя, после перезапуска они не нужны."""
+        return self._put(_Item("send_photo", chat_id, (photo,), kwargs, priority))
+
+    def send_document(self, chat_id, document, priority=INTERACTIVE, **kwargs):
+        """Файл (например, выгрузка export.py). Как и фото, в БД не сохраняется."""
+        return self._put(_Item("send_document", chat_id, (document,), kwargs, priority))
+
+    def send_many(self, messages, priority=BULK, advance=(), **kwargs):
+        """
+        messages — пары (chat_id, text). Все сообщения сначала одной транзакцией записываются в outbox,
+        затем ставятся в очередь. Возвращает список Future в том же порядке.
+        advance — перенос next_notify_utc в той же транзакции (см. db.add_outbox_messages).
+        """
+        kwargs_json = json.dumps(kwargs) if kwargs else None
+        ids = db.add_outbox_messages([(chat_id, text, kwargs_json, priority) for chat_id, text in messages],
+                                     self.owner, advance)
+        return [self._put(_Item("send_message", chat_id, (text,), kwargs, priority, row_id))
+                for (chat_id, text), row_id in zip(messages, ids)]
+
+    def _put(self, item):
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            item.seq = next(self._seq)
+            heapq.heappush(self._ready, (item.priority, item.seq, item))
+            self._cond.notify()
+        return item.future
+
+    # -------------------- Запуск и остановка --------------------
+    def start(self, recover=True):
+        """
+        Запускает диспетчер (иначе он стартует сам при первом сообщении).
+        recover — сразу забрать брошенные сообщения (после перезапуска).
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                return self
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox-send")
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+            if recover:
+                self._recover()
+        return self
+
+    def drain(self, timeout=None):
+        """Ждёт, пока очередь опустеет и все отправки завершатся. Возвращает False по таймауту."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._ready or self._delayed or self._busy_chats:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """Останавливает диспетчер. Сохранённые сообщения, не успевшие уйти, останутся в outbox."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._pool:
+            self._pool.shutdown(wait=True)
+
+    def _recover(self):
+        rows = db.claim_outbox(self.owner, time.time() - STALE_AFTER)
+        for row_id, chat_id, text, kwargs_json, priority in rows:
+            kwargs = json.loads(kwargs_json) if kwargs_json else {}
+            self._put(_Item("send_message", chat_id, (text,), kwargs, priority, row_id))
+        if rows:
+            print(f"Outbox: забрано недоставленных сообщений: {len(rows)}")
+
+    # -------------------- Диспетчер --------------------
+    def _next_item(self):
+        """Следующее сообщение, которое можно отправить сейчас, или None. Вызывается под _cond."""
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, item = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (item.priority, item.seq, item))
+        while self._ready:
+            _, _, item = heapq.heappop(self._ready)
+            if item.chat_id in self._busy_chats:
+                self._busy_chats[item.chat_id].append(item)
+                continue
+            free_at = self._chat_free_at.get(item.chat_id, 0.0)
+            if free_at > now:
+                heapq.heappush(self._delayed, (free_at, item.seq, item))
+                continue
+            self._busy_chats[item.chat_id] = []
+            self._in_flight += 1
+            return item
+        return None
+
+    def _run(self):
+        next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+        while True:
+            with self._cond:
+                item = None
+                while not self._stopped:
+                    item = self._next_item()
+                    if item is not None:
+                        break
+                    timeout = next_heartbeat - time.monotonic()
+                    if self._delayed:
+                        timeout = min(timeout, self._delayed[0][0] - time.monotonic())
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+
+            if time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+                self._heartbeat()
+            if item is not None:
+                self.bucket.acquire()
+                try:
+                    self._pool.submit(self._send, item)
+                except RuntimeError:
+                    return  # пул закрыт при завершении интерпретатора
+
+    def _heartbeat(self):
+        with self._cond:
+            now = time.monotonic()
+            self._chat_free_at = {chat_id: free_at for chat_id, free_at in self._chat_free_at.items()
+                                  if free_at > now}
+        try:
+            db.touch_outbox(self.owner)
+            self._recover()
+        except Exception as e:
+            print(f"Outbox: ошибка обслуживания таблицы: {e}")
+
+    def _send(self, item):
+        item.attempts += 1
+        # Файлы перематываются, чтобы повтор после 429 отправил их с начала
+        for arg in item.args:
+            if hasattr(arg, "seek"):
+                arg.seek(0)
+        try:
+            with metrics.timer(f"tg_{item.method}"):
+                result = getattr(self.bot, item.method)(item.chat_id, *item.args, **item.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                self.rate_limited += 1
+                item.attempts -= 1
+                return self._retry(item, retry_after)
+            if e.error_code >= 500 and item.attempts < MAX_ATTEMPTS:
+                return self._retry(item, RETRY_BASE_DELAY * 2 ** (item.attempts - 1))
+            # 400/403 (чат удалён, бот заблокирован) — повтор не поможет
+            return self._done(item, error=e)
+        except Exception as e:
+            if item.attempts < MAX_ATTEMPTS:
+                return self._retry(item, RETRY_BASE_DELAY * 2 ** (item.attempts - 1))
+            return self._done(item, error=e)
+        self._done(item, result=result)
+
+    def _release_chat(self, chat_id, free_at):
+        """Чат свободен с free_at; ожидавшие его сообщения возвращаются в очередь. Вызывается под _cond."""
+        self._in_flight -= 1
+        self._chat_free_at[chat_id] = max(free_at, self._chat_free_at.get(chat_id, 0.0))
+        for waiting in self._busy_chats.pop(chat_id, []):
+            heapq.heappush(self._ready, (waiting.priority, waiting.seq, waiting))
+        self._cond.notify_all()
+
+    def _retry(self, item, delay):
+        with self._cond:
+            self.retried += 1
+            not_before = time.monotonic() + delay
+            self._release_chat(item.chat_id, not_before)
+            heapq.heappush(self._delayed, (not_before, item.seq, item))
+
+    def _done(self, item, result=None, error=None):
+        # Строку удаляем до освобождения чата, чтобы после drain() отметка уже стояла в очереди записи
+        if item.row_id is not None:
+            db.write_queue.put_outbox_done(item.row_id)
+        now = time.monotonic()
+        with self._cond:
+            self._release_chat(item.chat_id, now + self.per_chat_interval)
+            if error is None:
+                self.sent += 1
+                self._sent_times.append(now)
+            else:
+                self.failed += 1
+        if error is None:
+            item.future.set_result(result)
+        else:
+            print(f"Outbox: сообщение в чат {item.chat_id} не доставлено: {error}")
+            item.future.set_exception(error)
+
+    # -------------------- Статистика --------------------
+    def send_rate(self):
+        """Сообщений в секунду за последнюю минуту."""
+        with self._cond:
+            cutoff = time.monotonic() - RATE_WINDOW
+            while self._sent_times and self._sent_times[0] < cutoff:
+                self._sent_times.popleft()
+            return round(len(self._sent_times) / RATE_WINDOW, 2)
+
+    def queue_depth(self):
+        with self._cond:
+            return (len(self._ready) + len(self._delayed)
+                    + sum(len(waiting) for waiting in self._busy_chats.values()))
+
+    def stats(self):
+        depth = self.queue_depth()
+        with self._cond:
+            counters = {"in_flight": self._in_flight, "sent": self.sent, "failed": self.failed,
+                        "retried": self.retried, "rate_limited": self.rate_limited}
+        return {"queue_depth": depth, "send_rate": self.send_rate(), **counters}
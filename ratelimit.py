@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+
+# Лимиты Telegram Bot API: ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+PER_CHAT_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """Потокобезопасное ведро токенов: rate токенов в секунду, не больше capacity за раз."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Забирает токен, если он есть. Иначе возвращает, сколько секунд ждать."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Блокирует поток, пока не появится токен."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
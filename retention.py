@@ -0,0 +1,108 @@
+# Хранение истории погоды: замеры старше RETENTION_DAYS сворачиваются в помесячную сводку weather_monthly,
+# сырые строки (и ставшие ненужными ответы API) удаляются небольшими пачками с паузами между ними,
+# чтобы не держать блокировку записи дольше одной короткой транзакции. Затем освободившиеся страницы
+# возвращаются системе (PRAGMA incremental_vacuum) и обновляется статистика планировщика (ANALYZE).
+#
+#   retention.start()              # фоновый поток в процессе бота, проход раз в RETENTION_INTERVAL
+#   python retention.py            # один проход вручную
+#   python retention.py --enable-incremental-vacuum   # один раз для базы, созданной до этой версии
+import argparse
+import datetime
+import os
+import threading
+import time
+
+import db
+import metrics
+
+# Аналитика смотрит не дальше 3 месяцев (messages.ANALYTICS_PERIODS), старше — только помесячно
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", str(6 * 3600)))
+RETENTION_BATCH_SIZE = 2000
+# Пауза между пачками: в неё проходят записи бота и воркеров
+RETENTION_PAUSE = 0.05
+# Сколько свободных страниц возвращать за один шаг incremental_vacuum (по 4 КиБ)
+VACUUM_PAGES = 2000
+# Строк на индекс для ANALYZE: статистика приблизительная, но проход не зависит от размера базы
+ANALYZE_LIMIT = 1000
+
+_thread = None
+_run_lock = threading.Lock()
+
+
+def _in_batches(step, pause):
+    total = 0
+    while True:
+        count = step()
+        total += count
+        if not count:
+            return total
+        time.sleep(pause)
+
+
+def run_retention(days=RETENTION_DAYS, batch_size=RETENTION_BATCH_SIZE, pause=RETENTION_PAUSE):
+    """Один проход обслуживания. Возвращает статистику. Параллельные проходы в одном процессе не запускаются."""
+    if not _run_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.perf_counter()
+        cutoff = datetime.date.today() - datetime.timedelta(days=days)
+        stats = {"cutoff": str(cutoff)}
+        with metrics.timer("retention_pass"):
+            stats["samples"] = _in_batches(lambda: db.roll_up_samples(cutoff, batch_size), pause)
+            stats["daily"] = _in_batches(lambda: db.prune_weather_daily(cutoff, batch_size), pause)
+            # Брошенные диалоги ("Выбрать город" без ответа) — их срок уже истёк
+            stats["conversations"] = db.prune_conversation_states(time.time())
+
+            stats["freed_pages"] = 0
+            if db.auto_vacuum_mode() == db.AUTO_VACUUM_INCREMENTAL:
+                while db.free_pages():
+                    before = db.free_pages()
+                    db.incremental_vacuum(VACUUM_PAGES)
+                    stats["freed_pages"] += before - db.free_pages()
+                    time.sleep(pause)
+            db.analyze(ANALYZE_LIMIT)
+        stats["wall_time"] = round(time.perf_counter() - started, 3)
+        metrics.inc("retention_samples_removed", stats["samples"])
+        return stats
+    finally:
+        _run_lock.release()
+
+
+def _run_forever(interval):
+    if db.auto_vacuum_mode() != db.AUTO_VACUUM_INCREMENTAL:
+        print("Retention: база без auto_vacuum=INCREMENTAL, файл не будет уменьшаться "
+              "(один раз: python retention.py --enable-incremental-vacuum)")
+    while True:
+        try:
+            stats = run_retention()
+            if stats and (stats["samples"] or stats["daily"]):
+                print(f"Retention: свёрнуто замеров {stats['samples']}, строк сводки удалено {stats['daily']}, "
+                      f"освобождено страниц {stats['freed_pages']}, время {stats['wall_time']} c")
+        except Exception as e:
+            print(f"Retention: ошибка обслуживания базы: {e}")
+        time.sleep(interval)
+
+
+def start(interval=RETENTION_INTERVAL):
+    """Запускает фоновое обслуживание (один поток на процесс). Первый проход — сразу."""
+    global _thread
+    if _thread is None:
+        _thread = threading.Thread(target=_run_forever, args=(interval,), name="retention", daemon=True)
+        _thread.start()
+    return _thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Свёртка старых замеров и обслуживание weather_bot.db")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="перевести базу в auto_vacuum=INCREMENTAL (полный VACUUM, база блокируется)")
+    args = parser.parse_args()
+
+    db.init_db()
+    if args.enable_incremental_vacuum:
+        print(f"auto_vacuum=INCREMENTAL: {'включён' if db.enable_incremental_vacuum() else 'не удалось'}")
+    size = os.path.getsize(db.DB_NAME)
+    stats = run_retention(args.days)
+    print(f"Готово: {stats}, размер базы {size / 2**20:.1f} -> {os.path.getsize(db.DB_NAME) / 2**20:.1f} МиБ")
@@ -1,42 +1,191 @@
 # google_sheets.py
+import atexit
 import os
+import random
+import threading
+import time
 from datetime import datetime
 import db
-from gspread import Spreadsheet
-from oauth2client.service_account import ServiceAccountCredentials
-import gspread
+import user_cache
+
+# Как часто фоновая очередь отправляет накопленные строки одним append_rows
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "5"))
+# Повторы при превышении квоты Google API: 1, 2, 4, 8, 16 секунд (+ случайная добавка)
+SHEETS_MAX_RETRIES = 5
+SHEETS_RETRY_BASE_DELAY = 1.0
+# Сколько секунд при завершении процесса ждём отправки строк, о которых пользователю уже ответили "в очереди"
+SHEETS_SHUTDOWN_TIMEOUT = 15
+
+_sheet = None
+_sheet_lock = threading.Lock()
+
 
 # Подключение к Google Sheets
-def get_sheet() -> Spreadsheet:
-    scope = ["https://spreadsheets.google.com/feeds",
-             "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
-        os.getenv("GOOGLE_CREDENTIALS_JSON"), scope
-    )
-    client = gspread.authorize(creds)
-    sheet = client.open_by_key(os.getenv("SPREADSHEET_ID")).sheet1
-    return sheet
+def get_sheet():
+    """Авторизованный лист таблицы (gspread.Worksheet). Ключ читается и клиент авторизуется один раз на процесс."""
+    global _sheet
+    if _sheet is None:
+        with _sheet_lock:
+            if _sheet is None:
+                # gspread и oauth2client тяжёлые при импорте, а экспорт нужен редко
+                import gspread
+                from oauth2client.service_account import ServiceAccountCredentials
+
+                scope = ["https://spreadsheets.google.com/feeds",
+                         "https://www.googleapis.com/auth/drive"]
+                creds = ServiceAccountCredentials.from_json_keyfile_name(
+                    os.getenv("GOOGLE_CREDENTIALS_JSON"), scope
+                )
+                client = gspread.authorize(creds)
+                _sheet = client.open_by_key(os.getenv("SPREADSHEET_ID")).sheet1
+    return _sheet
+
+
+def reset_sheet():
+    """Сбрасывает закэшированный клиент (например, после ошибки авторизации)."""
+    global _sheet
+    with _sheet_lock:
+        _sheet = None
 
 def append_rows_to_sheet(rows: list):
     """Добавляет список строк в конец таблицы"""
     sheet = get_sheet()
     sheet.append_rows(rows)
 
-def export_weather_to_sheets(tg_id, period="-1 month"):
-    """Экспорт погодной аналитики пользователя в Google Sheets"""
-    user = db.get_user_by_tg_id(tg_id)
+
+def _is_retryable(e):
+    """Квота (429) или временная ошибка сервера Google — можно повторить."""
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None) or getattr(e, "code", None)
+    return status in (429, 500, 502, 503) or "RATE_LIMIT_EXCEEDED" in str(e) or "Quota exceeded" in str(e)
+
+
+class SheetsExportQueue:
+    """
+    Фоновая очередь экспорта: строки разных пользователей копятся и раз в flush_interval
+    уходят в таблицу одним вызовом append_rows, с повторами при превышении квоты.
+    sheet_factory — функция, возвращающая объект с методом append_rows (в проверках можно подставить фейк).
+    """
+
+    def __init__(self, sheet_factory=get_sheet, flush_interval=SHEETS_FLUSH_INTERVAL,
+                 max_retries=SHEETS_MAX_RETRIES, retry_base_delay=SHEETS_RETRY_BASE_DELAY):
+        self.sheet_factory = sheet_factory
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+
+        self._rows = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._flushed_upto = 0  # сколько put уже записано (или отброшено)
+        self._queued = 0
+        self._flush_requested = False
+
+        self.appended_rows = 0
+        self.append_calls = 0
+        self.retries = 0
+        self.dropped_rows = 0
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="sheets-export", daemon=True)
+            self._thread.start()
+
+    def put(self, rows):
+        with self._cond:
+            self._ensure_started()
+            self._rows.extend(rows)
+            self._queued += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Просит отправить накопленное немедленно и ждёт, пока это произойдёт."""
+        with self._cond:
+            target = self._queued
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._flushed_upto >= target, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._rows, None)
+                # Даём интервал на накопление строк от других пользователей (если не попросили flush)
+                deadline = time.monotonic() + self.flush_interval
+                while not self._flush_requested:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._flush_requested = False
+                batch, self._rows = self._rows, []
+                upto = self._queued
+            self._append(batch)
+            with self._cond:
+                self._flushed_upto = upto
+                self._cond.notify_all()
+
+    def _append(self, rows):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sheet_factory().append_rows(rows)
+                self.append_calls += 1
+                self.appended_rows += len(rows)
+                return
+            except Exception as e:
+                if attempt < self.max_retries and _is_retryable(e):
+                    self.retries += 1
+                    time.sleep(self.retry_base_delay * 2 ** attempt + random.uniform(0, self.retry_base_delay))
+                    continue
+                self.dropped_rows += len(rows)
+                print(f"Ошибка экспорта в Google Sheets ({len(rows)} строк): {e}")
+                return
+
+    def stats(self):
+        with self._cond:
+            return {"pending_rows": len(self._rows), "appended_rows": self.appended_rows,
+                    "append_calls": self.append_calls, "retries": self.retries,
+                    "dropped_rows": self.dropped_rows}
+
+
+export_queue = SheetsExportQueue()
+# Как db.flush_writes: накопленное уходит в таблицу до выхода, а не теряется вместе с процессом
+atexit.register(export_queue.flush, SHEETS_SHUTDOWN_TIMEOUT)
+
+
+def build_export_rows(tg_id, period="-1 month"):
+    """Строки экспорта для пользователя. Возвращает (rows, None) или (None, текст ошибки)."""
+    user = user_cache.get_user(tg_id)
     if not user or not user.get("city"):
-        return "Сначала выберите город"
+        return None, "Сначала выберите город"
 
     city = user["city"]
     data = db.get_weather_counts(tg_id, city, period)
     if not data:
-        return "Нет данных для экспорта"
+        return None, "Нет данных для экспорта"
 
     today_str = datetime.today().strftime("%Y-%m-%d")
     rows = []
     for condition, count in data:
         rows.append([tg_id, city, today_str, condition, count])
+    return rows, None
+
+
+def export_weather_to_sheets(tg_id, period="-1 month"):
+    """Экспорт погодной аналитики пользователя в Google Sheets"""
+    rows, error = build_export_rows(tg_id, period)
+    if error:
+        return error
 
     append_rows_to_sheet(rows)
     return f"Экспорт завершён. Добавлено {len(rows)} строк"
+
+
+def queue_export(tg_id, period="-1 month"):
+    """Ставит экспорт в фоновую очередь и сразу возвращает ответ для пользователя."""
+    rows, error = build_export_rows(tg_id, period)
+    if error:
+        return error
+
+    export_queue.put(rows)
+    return f"Экспорт поставлен в очередь: {len(rows)} строк появятся в таблице в ближайшие секунды"
@@ -0,0 +1,164 @@
+# Кэш профилей пользователей в памяти процесса: обработчики кнопок не ходят в SQLite на каждое нажатие.
+# Записи обновляются сквозной записью (add_user, update_city, update_last_notify_date ниже), а изменения
+# из других процессов (воркеры рассылки, другие копии бота) ловятся по колонке users.version: запись,
+# проверенная больше USER_CACHE_REVALIDATE секунд назад, сверяет версию одним лёгким запросом.
+# USER_CACHE_REVALIDATE=0 — без сверки, только если пользователей обслуживает один процесс.
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+import metrics
+
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "50000"))
+# Как долго процесс может не видеть чужое изменение профиля (как CONVERSATION_REVALIDATE в conversation.py)
+USER_CACHE_REVALIDATE = float(os.getenv("USER_CACHE_REVALIDATE", "2"))
+
+
+class UserRecord:
+    """Компактная запись пользователя. Поддерживает user["city"] и user.get("city"), как словарь из db."""
+
+    __slots__ = ("tg_id", "chat_id", "city", "lat", "lon", "timezone", "tz_offset",
+                 "notify_morning", "last_notify_date", "next_notify_utc", "version")
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            setattr(self, name, row.get(name))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class UserCache:
+    """
+    LRU на max_size пользователей. Значение — (запись, время последней сверки с базой).
+    revalidate_after <= 0 — записи не сверяются с базой, пока их не вытеснят.
+    """
+
+    def __init__(self, max_size=USER_CACHE_MAX_SIZE, revalidate_after=USER_CACHE_REVALIDATE):
+        self.max_size = max_size
+        self.revalidate_after = revalidate_after
+        self._entries = OrderedDict()  # tg_id -> [record, checked_at]
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.reloaded = 0
+
+    def get(self, tg_id):
+        """Профиль пользователя или None, если его нет в базе."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(tg_id)
+            if entry is not None:
+                self._entries.move_to_end(tg_id)
+                if self.revalidate_after <= 0 or now - entry[1] < self.revalidate_after:
+                    self.hits += 1
+                    return entry[0]
+
+        if entry is not None:
+            # Запись могла измениться в другом процессе: сверяем только версию
+            if db.get_user_version(tg_id) == entry[0].version:
+                with self._lock:
+                    entry[1] = now
+                    self.revalidated += 1
+                return entry[0]
+            with self._lock:
+                self.reloaded += 1
+        else:
+            with self._lock:
+                self.misses += 1
+        metrics.inc("user_cache_loads")
+
+        row = db.get_user_by_tg_id(tg_id)
+        if row is None:
+            self.invalidate(tg_id)
+            return None
+        record = UserRecord(row)
+        self._put(record, now)
+        return record
+
+    def _put(self, record, checked_at):
+        with self._lock:
+            self._entries[record.tg_id] = [record, checked_at]
+            self._entries.move_to_end(record.tg_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _update(self, tg_id, version, bumped=True, **fields):
+        """
+        Сквозная запись: переносит изменённые поля в закэшированную запись. version — версия строки после записи,
+        bumped — увеличила ли запись версию. Если версия разошлась с ожидаемой (строку параллельно меняли
+        в другом процессе) или строки нет, запись просто выбрасывается и при следующем чтении загрузится заново.
+        """
+        with self._lock:
+            entry = self._entries.get(tg_id)
+            if entry is None:
+                return
+            record = entry[0]
+            if version is None or version != record.version + (1 if bumped else 0):
+                del self._entries[tg_id]
+                return
+            for name, value in fields.items():
+                setattr(record, name, value)
+            record.version = version
+            entry[1] = time.monotonic()
+
+    def invalidate(self, tg_id):
+        with self._lock:
+            self._entries.pop(tg_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.revalidated + self.reloaded + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "reloaded": self.reloaded,
+                "misses": self.misses,
+                # Доля нажатий, обслуженных без единого запроса к базе
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                # Доля нажатий, для которых понадобилась сверка версии (запрос к базе, но без чтения строки)
+                "revalidate_ratio": round(self.revalidated / total, 3) if total else 0.0,
+            }
+
+
+# Общий кэш процесса
+user_cache = UserCache()
+
+
+def get_user(tg_id):
+    """Замена db.get_user_by_tg_id для обработчиков."""
+    return user_cache.get(tg_id)
+
+
+def add_user(tg_id, chat_id):
+    # INSERT OR IGNORE не меняет существующую строку, поэтому версия должна совпасть с закэшированной
+    user_cache._update(tg_id, db.add_user(tg_id, chat_id), bumped=False)
+
+
+def update_city(tg_id, city, lat, lon, timezone=None, tz_offset=None):
+    next_notify, version = db.update_city(tg_id, city, lat, lon, timezone, tz_offset)
+    user_cache._update(tg_id, version, city=city, lat=lat, lon=lon, timezone=timezone,
+                       tz_offset=tz_offset, next_notify_utc=next_notify)
+
+
+def update_last_notify_date(tg_id, date_str):
+    version = db.update_last_notify_date(tg_id, date_str)
+    user_cache._update(tg_id, version, last_notify_date=date_str)
@@ -1,18 +1,59 @@
+import json
 import os
 import requests
 from dotenv import load_dotenv
+import metrics
+from circuit import CircuitBreaker
 
 load_dotenv()
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+# OWM_BASE_URL позволяет направить запросы на локальную заглушку (bench/fake_servers.py)
+OWM_BASE_URL = os.getenv("OWM_BASE_URL", "https://api.openweathermap.org")
+WEATHER_URL = f"{OWM_BASE_URL}/data/2.5/weather"
+FORECAST_URL = f"{OWM_BASE_URL}/data/2.5/forecast"
+REQUEST_TIMEOUT = 10
 
+# Общий предохранитель для текущей погоды и прогноза: если API не отвечает, запросы сразу
+# завершаются CircuitOpenError, а WeatherCache отдаёт последний удачный ответ с пометкой stale
+owm_breaker = CircuitBreaker("owm")
 
-def get_weather(lat, lon):
-    url = "https://api.openweathermap.org/data/2.5/weather"
+
+def _request(url, lat, lon):
     params = {"lat": lat, "lon": lon, "appid": WEATHER_API_KEY, "units": "metric"}
-    r = requests.get(url, params=params, timeout=10)
+    r = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
     r.raise_for_status()
-    data = r.json()
+    return r.json()
+
+
+@metrics.timed("weather_fetch")
+def get_weather(lat, lon):
+    return parse_weather(owm_breaker.call(_request, WEATHER_URL, lat, lon))
+
+
+@metrics.timed("forecast_fetch")
+def get_forecast(lat, lon):
+    """Прогноз на 5 дней с шагом 3 часа (/data/2.5/forecast). Ответ API без обработки — его разбирает forecast.py."""
+    return owm_breaker.call(_request, FORECAST_URL, lat, lon)
+
+
+async def get_weather_async(session, lat, lon):
+    """То же, что get_weather, но через общую aiohttp-сессию."""
+    params = {"lat": lat, "lon": lon, "appid": WEATHER_API_KEY, "units": "metric"}
+    owm_breaker.before_call()
+    try:
+        with metrics.timer("weather_fetch"):
+            async with session.get(WEATHER_URL, params=params) as r:
+                r.raise_for_status()
+                data = await r.json()
+    except Exception as e:
+        owm_breaker.record_failure(e, _request, WEATHER_URL, lat, lon)
+        raise
+    owm_breaker.record_success()
+    return parse_weather(data)
+
 
+def parse_weather(data):
+    """Приводит ответ /data/2.5/weather к словарю, с которым работает бот."""
     temp = data["main"]["temp"]
     temp_min = data["main"]["temp_min"]
     temp_max = data["main"]["temp_max"]
@@ -33,5 +74,5 @@ def get_weather(lat, lon):
         "condition": condition,
         "precipitation_type": precipitation_type,
         "pop": 0,
-        "raw_json": str(data)
+        "raw_json": json.dumps(data, ensure_ascii=False)
     }
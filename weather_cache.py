@@ -0,0 +1,224 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from weather import get_weather
+
+# -------------------- Настройки кэша --------------------
+# Шаг сетки в градусах: все координаты внутри одной ячейки считаются одной точкой
+CACHE_GRID = float(os.getenv("WEATHER_CACHE_GRID", "0.05"))
+# Сколько секунд ответ OpenWeatherMap считается свежим
+CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "600"))
+# Максимальное число ячеек в памяти (LRU)
+CACHE_MAX_SIZE = int(os.getenv("WEATHER_CACHE_MAX_SIZE", "5000"))
+# Если API не отвечает, истёкший ответ не старше стольких секунд отдаётся с пометкой stale
+STALE_MAX_AGE = int(os.getenv("WEATHER_STALE_MAX_AGE", "10800"))
+
+
+def cell_key(lat, lon, grid=CACHE_GRID):
+    """Округляет координаты до ячейки сетки. Возвращает кортеж (lat, lon) центра ячейки."""
+    return (round(round(float(lat) / grid) * grid, 6),
+            round(round(float(lon) / grid) * grid, 6))
+
+
+class _InFlight:
+    """Запрос к API, который уже выполняется: остальные ждут его результат."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WeatherCache:
+    """
+    Кэш погоды по ячейкам координат с TTL, LRU-вытеснением и склейкой одновременных запросов.
+    Истёкшие записи живут до вытеснения: при ошибке запроса (в том числе разомкнутом предохранителе)
+    отдаётся последний удачный ответ не старше stale_max_age — копия с ключами stale=True и stale_age (секунды).
+    """
+
+    def __init__(self, fetch=get_weather, grid=CACHE_GRID, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE,
+                 stale_max_age=STALE_MAX_AGE):
+        self.fetch = fetch
+        self.grid = grid
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stale_max_age = stale_max_age
+
+        self._entries = OrderedDict()  # key -> (expires_at, weather, fetched_at)
+        self._in_flight = {}           # key -> _InFlight
+        self._async_in_flight = {}     # key -> asyncio.Future (для bot_async.py)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale = 0
+
+    def get(self, lat, lon):
+        """Возвращает погоду для ячейки: из кэша, из уже идущего запроса или новым запросом."""
+        key = cell_key(lat, lon, self.grid)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            waiter = self._in_flight.get(key)
+            owner = waiter is None
+            if owner:
+                waiter = _InFlight()
+                self._in_flight[key] = waiter
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            waiter.event.wait()
+            if waiter.error:
+                # Владельцем могла быть предзагрузка: она не подставляет устаревший ответ
+                result = self._stale(key)
+                if result is None:
+                    raise waiter.error
+                return result
+            return waiter.result
+
+        try:
+            # Запрашиваем центр ячейки, чтобы ответ был одинаковым для всех её пользователей
+            waiter.result = self.fetch(key[0], key[1])
+            self._store(key, waiter.result)
+            return waiter.result
+        except Exception as e:
+            waiter.result = self._stale(key)
+            if waiter.result is None:
+                waiter.error = e
+                raise
+            return waiter.result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            waiter.event.set()
+
+    async def get_async(self, lat, lon, fetch_async):
+        """Асинхронный вариант get: fetch_async(lat, lon) — корутина, склейка запросов через asyncio.Future."""
+        key = cell_key(lat, lon, self.grid)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            future = self._async_in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = asyncio.get_running_loop().create_future()
+                self._async_in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return await asyncio.shield(future)
+
+        try:
+            result = await fetch_async(key[0], key[1])
+            self._store(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            result = self._stale(key)
+            if result is not None:
+                future.set_result(result)
+                return result
+            future.set_exception(e)
+            future.exception()  # ошибку уже получил владелец, ожидающих может не быть
+            raise
+        finally:
+            with self._lock:
+                self._async_in_flight.pop(key, None)
+            # Владельца отменили (CancelledError не Exception): ожидающие не должны висеть вечно
+            if not future.done():
+                future.cancel()
+
+    def warm(self, lat, lon, lead):
+        """
+        Предзагрузка: запрашивает ячейку, если её нет в кэше или она истечёт раньше чем через lead секунд.
+        Загруженная запись живёт lead + ttl, чтобы дожить до рассылки. Возвращает True, если был запрос к API.
+        Запрос регистрируется как идущий: get той же ячейки дождётся его, а не пойдёт в API второй раз.
+        """
+        key = cell_key(lat, lon, self.grid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic() + lead:
+                return False
+            if key in self._in_flight:
+                # Ячейку уже запрашивает get или другая предзагрузка
+                self.coalesced += 1
+                return False
+            waiter = _InFlight()
+            self._in_flight[key] = waiter
+            self.misses += 1
+
+        try:
+            waiter.result = self.fetch(key[0], key[1])
+            self._store(key, waiter.result, lead + self.ttl)
+            return True
+        except Exception as e:
+            waiter.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            waiter.event.set()
+
+    def _store(self, key, weather, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (now + (ttl if ttl is not None else self.ttl), weather, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _stale(self, key):
+        """Последний удачный ответ для ячейки с пометкой stale или None, если его нет или он слишком старый."""
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry[2] if entry else None
+            if age is None or age > self.stale_max_age:
+                return None
+            self.stale += 1
+        metrics.inc("weather_stale_served")
+        return dict(entry[1], stale=True, stale_age=int(age))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Счётчики для проверки экономии квоты API."""
+        with self._lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "stale": self.stale,
+                "size": len(self._entries),
+                "hit_ratio": round((self.hits + self.coalesced) / total, 3) if total else 0.0,
+            }
+
+
+# Общий кэш процесса
+weather_cache = WeatherCache()
+
+
+def get_weather_cached(lat, lon):
+    """Замена weather.get_weather с кэшированием по ячейкам."""
+    return weather_cache.get(lat, lon)
@@ -0,0 +1,176 @@
+# Режим webhook: Telegram присылает обновления POST-запросами, вместо long polling.
+# Запуск: python webhook.py  (WEBHOOK_URL — публичный адрес, по которому Telegram будет слать обновления)
+#
+# Локальная проверка без Telegram — отправить записанное обновление:
+#   curl -X POST -H "Content-Type: application/json" \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        --data @update.json http://localhost:8080/telegram
+#   curl http://localhost:8080/stats
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Размер очереди и число обработчиков: при заполненной очереди отвечаем 503, Telegram повторит позже
+QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+
+
+class UpdateDispatcher:
+    """Очередь входящих обновлений и пул потоков, передающих их в обработчики бота."""
+
+    def __init__(self, bot, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.bot = bot
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.rejected = 0
+        self.dispatched = 0
+        self.failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, update_json):
+        """Ставит обновление в очередь. Возвращает False, если очередь переполнена."""
+        try:
+            self.queue.put_nowait((time.monotonic(), update_json))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.received += 1
+        return True
+
+    def _run(self):
+        while True:
+            enqueued_at, update_json = self.queue.get()
+            try:
+                update = telebot.types.Update.de_json(update_json)
+                # Вызывает те же обработчики, что и infinity_polling (start, setcity, reply_buttons, ...)
+                self.bot.process_new_updates([update])
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"Ошибка обработки обновления: {e}")
+            latency = time.monotonic() - enqueued_at
+            with self._lock:
+                if ok:
+                    self.dispatched += 1
+                else:
+                    self.failed += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+            self.queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            done = self.dispatched + self.failed
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "received": self.received,
+                "rejected": self.rejected,
+                "dispatched": self.dispatched,
+                "failed": self.failed,
+                "dispatch_latency_avg": round(self._latency_total / done, 4) if done else 0.0,
+                "dispatch_latency_max": round(self._latency_max, 4),
+            }
+
+
+def make_handler(dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body=b"", content_type="text/plain"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != path:
+                return self._reply(404)
+            if secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                return self._reply(403)
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode("utf-8")
+            try:
+                json.loads(body)
+            except ValueError:
+                return self._reply(400)
+            if not dispatcher.submit(body):
+                # Очередь переполнена — Telegram повторит доставку позже
+                return self._reply(503)
+            self._reply(200)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                return self._reply(200, json.dumps(dispatcher.stats()).encode("utf-8"), "application/json")
+            if self.path == "/metrics":
+                return self._reply(200, metrics.render_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+            self._reply(404)
+
+        def log_message(self, format, *args):
+            pass  # не засоряем вывод строкой на каждый апдейт
+
+    return WebhookHandler
+
+
+def serve(bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """Запускает HTTP-сервер webhook и пул обработчиков. Блокирует текущий поток."""
+    # Обработчики должны выполняться в нашем пуле, а не во внутреннем пуле TeleBot,
+    # иначе очередь и задержка диспетчеризации ничего не говорят о реальной нагрузке
+    bot.threaded = False
+    dispatcher = UpdateDispatcher(bot)
+    dispatcher.start()
+    metrics.register_gauge("webhook_queue_depth", lambda: dispatcher.queue.qsize())
+    server = ThreadingHTTPServer((host, port), make_handler(dispatcher))
+    print(f"Webhook слушает http://{host}:{port}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+
+# -------------------- Запуск бота --------------------
+if __name__ == "__main__":
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # Без секрета любой, кто знает адрес, может присылать боту поддельные обновления
+        raise SystemExit("WEBHOOK_URL задан без WEBHOOK_SECRET: webhook не запущен")
+
+    import bot as bot_module
+
+    bot_module.db.init_db()
+    # SIGTERM (docker stop, systemd) — обычный выход: atexit допишет очередь записи в БД и экспорт в Sheets
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if bot_module.notifier.RUN_SCHEDULER:
+        threading.Thread(target=bot_module.run_scheduled_notifications, daemon=True).start()
+    if os.getenv("RUN_RETENTION", "1") == "1":
+        bot_module.retention.start()
+
+    if WEBHOOK_URL:
+        bot_module.bot.remove_webhook()
+        bot_module.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    serve(bot_module.bot)
@@ -0,0 +1,138 @@
+# Режим воркеров рассылки: N процессов, каждый владеет шардом пользователей (tg_id % N).
+# Шард закрепляется арендой в таблице notify_leases; если воркер упал и перестал её продлевать,
+# после истечения аренды шард обрабатывает любой другой воркер.
+# Запуск: python worker.py --workers 4   (а сам бот — с RUN_SCHEDULER=0, см. notifier.RUN_SCHEDULER)
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+
+import db
+import notifier
+from outbox import Outbox
+from ratelimit import GLOBAL_RATE
+
+# Аренда продлевается на каждом тике и по ходу рассылки (lease_keeper), поэтому она должна быть заметно длиннее тика
+LEASE_TTL = float(os.getenv("WORKER_LEASE_TTL", "180"))
+TICK_SECONDS = float(os.getenv("WORKER_TICK_SECONDS", "30"))
+
+
+def lease_keeper(shard, owner, ttl):
+    """
+    keep_lease для notifier.run_morning_notifications: продлевает аренду шарда, если с прошлого продления
+    прошла треть ttl (раньше её никто забрать не может), и возвращает False, если шард уже чужой.
+    """
+    renewed_at = time.monotonic()
+
+    def keep_lease():
+        nonlocal renewed_at
+        if time.monotonic() - renewed_at < ttl / 3:
+            return True
+        if not db.claim_shard(shard, owner, ttl):
+            return False
+        renewed_at = time.monotonic()
+        return True
+
+    return keep_lease
+
+
+def _default_bot():
+    import telebot
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return telebot.TeleBot(os.getenv("TELEGRAM_TOKEN"))
+
+
+def run_worker(worker_id, shards, bot_factory=_default_bot, fetch=None, until_idle=False,
+               tick_seconds=TICK_SECONDS, lease_ttl=LEASE_TTL, global_rate=GLOBAL_RATE, db_name=None):
+    """
+    Цикл одного воркера. Свой шард (worker_id % shards) продлевается каждый тик;
+    чужие шарды берутся только при истёкшей аренде и отпускаются сразу после обработки.
+    until_idle — выйти, когда во всех доступных шардах не осталось должников (для бенчмарка).
+    fetch — подмена weather.get_weather (для бенчмарка с заглушкой погоды).
+    Возвращает статистику: отправлено сообщений и число обработанных чужих шардов.
+    """
+    if db_name:
+        db.DB_NAME = db_name
+    if fetch is not None:
+        from weather_cache import weather_cache
+        weather_cache.fetch = fetch
+
+    bot = bot_factory()
+    owner = f"{socket.gethostname()}:{os.getpid()}:{worker_id}"
+    own_shard = worker_id % shards
+    # Лимит Telegram общий для бота, поэтому делим его между воркерами
+    rate = global_rate / shards
+    totals = {"worker": worker_id, "sent": 0, "users": 0, "takeovers": 0, "started": time.time()}
+    # Своя очередь на процесс: при старте забирает сообщения, брошенные упавшим воркером
+    outbox = Outbox(bot, global_rate=rate).start()
+
+    try:
+        while True:
+            processed = 0
+            # Погода для своего шарда на ближайшие минуты — заранее, чтобы рассылка только читала кэш
+            notifier.prefetch_upcoming(shard=own_shard, shards=shards)
+            for shard in [own_shard] + [s for s in range(shards) if s != own_shard]:
+                if not db.claim_shard(shard, owner, lease_ttl):
+                    continue
+                try:
+                    # Аренда продлевается по ходу прохода: выборка погоды и постановка в очередь
+                    # могут идти дольше lease_ttl
+                    stats = notifier.run_morning_notifications(bot, shard=shard, shards=shards, outbox=outbox,
+                                                               keep_lease=lease_keeper(shard, owner, lease_ttl))
+                finally:
+                    if shard != own_shard:
+                        db.release_shard(shard, owner)
+                if stats["lease_lost"]:
+                    print(f"[worker {worker_id}] шард {shard}: аренду забрал другой воркер, проход остановлен")
+                if shard != own_shard and stats["users"]:
+                    totals["takeovers"] += 1
+                totals["sent"] += stats["sent"]
+                totals["users"] += stats["users"]
+                # Должники, для которых погоду получить не удалось, остаются в выборке: если никто не перенесён,
+                # цикл ждёт тик, а не запрашивает упавший API снова и снова
+                processed += stats["advanced"]
+                if stats["users"]:
+                    print(f"[worker {worker_id}] шард {shard}: пользователей {stats['users']}, "
+                          f"отправлено {stats['sent']}, {stats['throughput']} сообщ./с")
+
+            if until_idle and not processed:
+                totals["finished"] = time.time()
+                return totals
+            if not processed:
+                time.sleep(tick_seconds)
+    finally:
+        outbox.stop()
+        db.release_shard(own_shard, owner)
+        db.close_conn()
+
+
+def _worker_entry(args, results):
+    worker_id, shards, kwargs = args
+    results.put(run_worker(worker_id, shards, **kwargs))
+
+
+def run_workers(count, **kwargs):
+    """Запускает count процессов-воркеров и ждёт их завершения. Возвращает список их статистик."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_worker_entry, args=((i, count, kwargs), results), name=f"notify-worker-{i}")
+                 for i in range(count)]
+    for p in processes:
+        p.start()
+    collected = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return collected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Воркеры утренней рассылки с шардированием по tg_id")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    db.init_db()
+    print(f"Запускаем воркеров: {args.workers}")
+    run_workers(args.workers)